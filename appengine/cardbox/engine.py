@@ -2,20 +2,29 @@
 
 # Python Imports
 import datetime
+import time
 import logging
 import yaml
+import bisect
+import uuid
+import copy
+import pickle
 
 # AppEngine Imports
 from google.appengine.ext import deferred
 from google.appengine.runtime import DeadlineExceededError
 from google.appengine.ext import db
+from google.appengine.api import datastore
 
 # Django Imports
 from django.template import Template
+from django.utils import simplejson
 
 # Library imports
 import mapreduce as mr
 
+from tools.rpc_counter import RPCCounter
+
 # Local Imports
 import models
 
@@ -37,14 +46,28 @@ class Mapper(object):
     FILTERS = []
     # Set this only keys have to be returned
     KEYS_ONLY = False
+    # Set this to query keys first, and get the entities in parallel chunks
+    KEYS_FIRST = False
+    GET_CHUNK_SIZE = 50
     # Set to run mapper in a specific queue
     QUEUE = 'default'
+    # Seconds a task maps batches before it re-queues itself
+    TIME_BUDGET = 20
+    # The batch size is adapted so a batch takes about BATCH_TIME seconds
+    BATCH_TIME = 2.0
+    MIN_BATCH_SIZE = 10
+    MAX_BATCH_SIZE = 500
 
     def __init__(self, next_mapper=None, ancestor=None):
         self.to_put = []
         self.to_delete = []
         self.next_mapper = next_mapper
         self.ancestor = ancestor
+        self.metrics = {'tasks':0, 'entities':0, 'rpcs':0, 'seconds':0.0}
+        # Set on the shards of a sharded run, see run_sharded()
+        self.key_range = None
+        self.shard_job_id = None
+        self.shard = None
 
     def map(self, entity):
         """ Updates a single entity.
@@ -60,13 +83,25 @@ class Mapper(object):
             self.next_mapper.run()
         pass
 
+    def metrics_summary(self):
+        m = self.metrics
+        rate = m['entities'] / m['seconds'] if m['seconds'] > 0 else 0.0
+        return '%d entities in %d tasks, %d datastore RPCs, %.1f entities/s' % (
+            m['entities'], m['tasks'], m['rpcs'], rate)
+
     def get_query(self):
         """Returns a query over the specified kind, with any appropriate filters applied."""
-        q = db.Query(self.KIND,keys_only=self.KEYS_ONLY)
+        q = db.Query(self.KIND,keys_only=(self.KEYS_ONLY or self.KEYS_FIRST))
         for prop, value in self.FILTERS:
             q.filter("%s =" % prop, value)
         if self.ancestor:
             q.ancestor(self.ancestor)
+        if self.key_range is not None:
+            start, end = self.key_range
+            if start is not None:
+                q.filter('__key__ >=', start)
+            if end is not None:
+                q.filter('__key__ <', end)
         q.order(self.ORDER_BY)
         return q
 
@@ -75,6 +110,69 @@ class Mapper(object):
         logging.info('%s: Starting.'% (self.__class__.__name__))
         deferred.defer(self._continue, None, batch_size, _queue=self.QUEUE)
 
+    def run_sharded(self, shards=8, batch_size=20):
+        """Starts the mapper as concurrent shards, each over its own key
+           range. When the last shard completes, it merges the others into
+           itself with merge_shard() and calls finish() once.
+           Only for mappers over all entities of a kind, ordered by key.
+        """
+        if self.ancestor is not None or self.ORDER_BY != '__key__':
+            raise Exception("Only mappers over a whole kind, by key, can be sharded.")
+        logging.info('%s: Starting %d shards.'% (self.__class__.__name__, shards))
+        deferred.defer(self._start_shards, shards, batch_size, _queue=self.QUEUE)
+        
+    def _start_shards(self, shards, batch_size):
+        # Scatter keys are a uniform sample of the kind's keys.
+        OVERSAMPLING = 32
+        q = datastore.Query(self.KIND.kind(), keys_only=True)
+        q.Order('__scatter__')
+        samples = sorted(q.Get(shards * OVERSAMPLING))
+        splits = [samples[len(samples) * i // shards] for i in range(1, shards)] if samples else []
+        splits = sorted(set(splits))
+        bounds = [None] + splits + [None]
+        job_id = uuid.uuid4().hex
+        models.MapperJob(key_name=job_id, shards=len(bounds) - 1).put()
+        for i in range(len(bounds) - 1):
+            shard = copy.deepcopy(self)
+            shard.key_range = (bounds[i], bounds[i+1])
+            shard.shard_job_id = job_id
+            shard.shard = i
+            deferred.defer(shard._continue, None, batch_size, _queue=self.QUEUE)
+        logging.info('%s: Started %d shards for job %s.'% (self.__class__.__name__, len(bounds) - 1, job_id))
+        
+    def merge_shard(self, other):
+        """Called on the last shard to finish with each of the other shards,
+           subclasses that collect state in map() should merge it here."""
+        for k in self.metrics:
+            self.metrics[k] += other.metrics[k]
+            
+    def _finish_shard(self):
+        """Records this shard as done. Calls finish() if it was the last one."""
+        state = db.Blob(pickle.dumps(self, pickle.HIGHEST_PROTOCOL))
+        def txn():
+            job = models.MapperJob.get_by_key_name(self.shard_job_id)
+            if job is None:
+                return None
+            if self.shard not in job.done_shards:
+                job.done_shards.append(self.shard)
+                job.states.append(state)
+                job.put()
+            return job
+        job = db.run_in_transaction(txn)
+        if job is None:
+            # A retried task, the last shard already finished the job.
+            logging.info('%s: job %s already finished.' % (self.__class__.__name__, self.shard_job_id))
+            return
+        if len(job.done_shards) < job.shards:
+            logging.info('%s: shard %d of job %s done.' % (self.__class__.__name__, self.shard, self.shard_job_id))
+            return
+        for shard, other in zip(job.done_shards, job.states):
+            if shard != self.shard:
+                self.merge_shard(pickle.loads(other))
+        db.delete(job)
+        logging.info('%s: all shards done, %s' % (self.__class__.__name__, self.metrics_summary()))
+        self.finish()
+
     def _batch_write(self):
         """Writes updates and deletes entities in a batch."""
         if self.to_put:
@@ -83,45 +181,90 @@ class Mapper(object):
         if self.to_delete:
             db.delete(self.to_delete)
             self.to_delete = []
+            
+    def _next_batch_size(self, batch_size, n_mapped, elapsed):
+        """Scales the batch size so a batch takes about BATCH_TIME seconds."""
+        if n_mapped == 0 or elapsed <= 0:
+            return batch_size
+        target = self.BATCH_TIME * n_mapped / elapsed
+        target = min(batch_size * 2, max(batch_size // 2, int(target)))
+        return min(self.MAX_BATCH_SIZE, max(self.MIN_BATCH_SIZE, target))
 
-    def _continue(self, start_key, batch_size):
-        q = self.get_query()
-
-        # If we're resuming, pick up where we left off last time.
-        if start_key:
-            q.filter("%s >" % self.ORDER_BY, start_key)
+    def _fetch(self, q, batch_size, skip):
+        """Returns the entities to map, one per query result.
+           With KEYS_FIRST, the keys are fetched first and the entities are
+           then fetched in chunks of GET_CHUNK_SIZE by concurrent async gets.
+           Entities deleted in between are None.
+        """
+        res = q.fetch(batch_size, offset=skip)
+        if self.KEYS_ONLY or not self.KEYS_FIRST:
+            return res
+        rpcs = [db.get_async(res[i:i+self.GET_CHUNK_SIZE])
+                for i in xrange(0, len(res), self.GET_CHUNK_SIZE)]
+        entities = []
+        for rpc in rpcs:
+            entities.extend(rpc.get_result())
+        return entities
+        
+    def _record_task(self, start, counter):
+        self.metrics['tasks'] += 1
+        self.metrics['rpcs'] += counter.count('datastore_v3')
+        self.metrics['seconds'] += time.time() - start
 
-        # Keep updating records until we run out of time.
-        continue_key = None
+    def _continue(self, cursor, batch_size, skip=0):
+        """Maps batches from the query cursor onwards until TIME_BUDGET is
+           spent, then re-queues itself with the cursor of the last batch.
+           If the deadline is hit halfway a batch, the next task skips the
+           query results that were already done.
+        """
+        with RPCCounter() as counter:
+            self._continue_batches(cursor, batch_size, skip, counter)
+            
+    def _continue_batches(self, cursor, batch_size, skip, counter):
+        start = time.time()
+        # Query results done in the current batch, deleted entities included
+        n_done = 0
         try:
-            # Steps over the results, returning each entity and its index.
-            res = q.fetch(batch_size)
-            for i, entity in enumerate(res):
-                map_updates, map_deletes = self.map(entity)
-                self.to_put.extend(map_updates)
-                self.to_delete.extend(map_deletes)
-                if self.KEYS_ONLY:
-                    continue_key = entity
-                else:
-                    if self.ORDER_BY == '__key__':
-                        continue_key = entity.key()
-                    else:
-                        continue_key = getattr(entity, self.ORDER_BY)
-            self._batch_write()
+            while True:
+                q = self.get_query()
+                if cursor:
+                    q.with_cursor(cursor)
+                batch_start = time.time()
+                n_done = n_mapped = 0
+                res = self._fetch(q, batch_size, skip)
+                for entity in res:
+                    if entity is not None:
+                        map_updates, map_deletes = self.map(entity)
+                        self.to_put.extend(map_updates)
+                        self.to_delete.extend(map_deletes)
+                        n_mapped += 1
+                        self.metrics['entities'] += 1
+                    n_done += 1
+                self._batch_write()
+                if len(res) < batch_size:
+                    break
+                batch_size = self._next_batch_size(batch_size, n_mapped, time.time() - batch_start)
+                cursor, skip, n_done = q.cursor(), 0, 0
+                if time.time() - start > self.TIME_BUDGET:
+                    logging.info('%s: time budget spent, enqueing with batches of %d.' % (
+                        self.__class__.__name__, batch_size))
+                    self._record_task(start, counter)
+                    deferred.defer(self._continue, cursor, batch_size, _queue=self.QUEUE)
+                    return
         except DeadlineExceededError:
             logging.info('%s: hit DeadlineExceededError' % (self.__class__.__name__))
             # Write any unfinished updates to the datastore.
             self._batch_write()
             # Queue a new task to pick up where we left off.
-            deferred.defer(self._continue, continue_key, batch_size, _queue=self.QUEUE)
+            self._record_task(start, counter)
+            deferred.defer(self._continue, cursor, batch_size, skip + n_done, _queue=self.QUEUE)
             return
-
-        if continue_key is not None:
-            logging.info('%s: batch of %d finished, enqueing.' % (self.__class__.__name__,
-                                                                 batch_size))
-            deferred.defer(self._continue, continue_key, batch_size, _queue=self.QUEUE)
-        else:
-            self.finish()
+        self._record_task(start, counter)
+        if self.shard_job_id is not None:
+            self._finish_shard()
+            return
+        logging.info('%s: done, %s' % (self.__class__.__name__, self.metrics_summary()))
+        self.finish()
             
 ### Card Cleaner/Creator ###
 
@@ -129,22 +272,44 @@ def update_cards(card_ids, box):
     c = CardCleaner(card_ids=card_ids,ancestor=box)
     c.run()
 
-def clean_all_cards():
+def clean_all_cards(shards=8):
     c = CardCleaner(card_ids=None, ancestor=None)
-    c.run()
+    c.run_sharded(shards)
 
 class CardCleaner(Mapper):
     """ Runs through all the cards in a given box (ancestor),
         and checks whether the card is still part of that box.
         At the end, the remaining cards that should be in the box but are not
         will be added by calling create_cards()
+        
+        The expected card names are kept sorted in a JobPayload, and merged
+        against the cards, which come in key order. Only the merge position
+        and the ranges of missing names are carried between tasks.
     """
     KIND = models.Card
     QUEUE = 'cardcleaner'
+    KEYS_FIRST = True
     
     def __init__(self, card_ids=None, **kwds):
-        self.card_ids = card_ids
+        self.job_id = None
+        self.position = 0
+        self.missing = []
+        self._expected = None
+        if card_ids is not None:
+            self.job_id = uuid.uuid4().hex
+            self._expected = sorted('-'.join([str(p) for p in id_tuple]) for id_tuple in card_ids)
+            models.JobPayload.save(self.job_id, self._expected)
         Mapper.__init__(self, **kwds)
+        
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_expected'] = None
+        return state
+        
+    def expected(self):
+        if self._expected is None:
+            self._expected = models.JobPayload.load(self.job_id) if self.job_id else []
+        return self._expected
     
     def map(self, card):
         box = card.parent()
@@ -152,9 +317,13 @@ class CardCleaner(Mapper):
             return ([],[card])
         if not self.ancestor:
             return ([],[])
-        a,b = card.key().name().split('-',1)
-        id_tuple = (int(a),b)
-        if  id_tuple not in self.card_ids:
+        name = card.key().name()
+        expected = self.expected()
+        i = bisect.bisect_left(expected, name, self.position)
+        if i > self.position:
+            self.missing.append((self.position, i))
+        if i == len(expected) or expected[i] != name:
+            self.position = i
             if (card.modified - datetime.datetime.now()).days > 30:
                 return ([],[card])
             elif card.enabled:
@@ -163,92 +332,245 @@ class CardCleaner(Mapper):
             else:
                 return ([],[])
         else:
+            self.position = i + 1
             card.enabled = True
-            self.card_ids.remove(id_tuple)
             return ([card],[])
                 
     def finish(self):
-        if self.card_ids:
-            logging.info("CardCleaner finished. Creating %d cards."%len(self.card_ids))
-            create_cards(self.card_ids, self.ancestor)
+        if not self.ancestor:
+            return
+        models.StudyQueue.invalidate(self.ancestor)
+        expected = self.expected()
+        if self.position < len(expected):
+            self.missing.append((self.position, len(expected)))
+        card_ids = []
+        for start, end in self.missing:
+            for name in expected[start:end]:
+                a,b = name.split('-',1)
+                card_ids.append((int(a),b))
+        if self.job_id:
+            models.JobPayload.remove(self.job_id)
+        if card_ids:
+            logging.info("CardCleaner finished. Creating %d cards."%len(card_ids))
+            create_cards(card_ids, self.ancestor)
         else:
             logging.info("CardCleaner finished. No cards to add.")
+            reconcile_box_counters(self.ancestor)
 
 
-def create_cards(card_ids, box_key):
+def create_cards(card_ids, box_key, batch_size=250, time_budget=20):
     """ Adds Card entities for the given ids, with the given parent.
-        Adds in batches and re-queues itself. 
+        Each batch is fetched with one get and written with one put. 
+        Re-queues itself with the remainder once time_budget seconds
+        are spent or the request deadline is hit.
     """
-    if len(card_ids) == 0:
-        return
-    BATCH_SIZE = 20
-    batch = card_ids[:BATCH_SIZE]
-    logging.info("Adding cards for %s (%d remaining). Batch: %s"%(box_key,len(card_ids),batch))
-    for id_tuple in batch:
-        key = '-'.join([str(p) for p in id_tuple])
-        card = models.Card.get_by_key_name(key, parent=box_key)
-        if card is None:
-            logging.info("Creating card for %s"%(str(id_tuple)))
-            card = models.Card(key_name=key, parent=box_key)
-        card.enabled = True
-        card.put()
-    deferred.defer(create_cards,
-                   card_ids[BATCH_SIZE:],
-                   box_key, _queue='cardcleaner')
+    start = time.time()
+    logging.info("Adding cards for %s (%d remaining)."%(box_key,len(card_ids)))
+    try:
+        while card_ids and (time.time() - start) < time_budget:
+            batch = card_ids[:batch_size]
+            key_names = ['-'.join([str(p) for p in id_tuple]) for id_tuple in batch]
+            cards = models.Card.get_by_key_name(key_names, parent=box_key)
+            for i, key_name in enumerate(key_names):
+                if cards[i] is None:
+                    cards[i] = models.Card(key_name=key_name, parent=box_key)
+                cards[i].enabled = True
+            db.put(cards)
+            card_ids = card_ids[batch_size:]
+    except DeadlineExceededError:
+        logging.info("create_cards: hit DeadlineExceededError")
+    models.StudyQueue.invalidate(box_key)
+    if card_ids:
+        deferred.defer(create_cards, card_ids, box_key, batch_size, time_budget,
+                       _queue='cardcleaner')
+    else:
+        reconcile_box_counters(box_key)
+   
+   
+def rebuild_study_queue(box_key):
+    """ Rebuilds the StudyQueue of a box, unless a request already did. """
+    box_key = db.Key(box_key)
+    def txn():
+        queue, stamp = db.get([models.StudyQueue.key_for(box_key),
+                               models.StudyQueueStamp.key_for(box_key)])
+        generation = models.StudyQueueStamp.generation_of(stamp)
+        if queue is None or queue.generation != generation:
+            models.StudyQueue.rebuild(box_key, generation).put()
+    db.run_in_transaction(txn)
    
    
+### Box Counters ###
+
+def reconcile_box_counters(box_key):
+    """ Recounts the denormalized card counters of a box. """
+    if isinstance(box_key, basestring):
+        box_key = db.Key(box_key)
+    BoxCounterMapper(ancestor=box_key).run()
+    
+def reconcile_all_box_counters():
+    for key in models.Box.all(keys_only=True):
+        reconcile_box_counters(key)
+
+class BoxCounterMapper(Mapper):
+    """ Counts the enabled cards in a box and when they are learned until,
+        and overwrites the box's counters to repair any drift.
+    """
+    KIND = models.Card
+    FILTERS = [('enabled',True)]
+    QUEUE = 'boxstats'
+    
+    def __init__(self, **kwds):
+        self.n_cards = 0
+        self.learned_hours = {}
+        self.learned_minutes = {}
+        Mapper.__init__(self, **kwds)
+        
+    def map(self, card):
+        self.n_cards += 1
+        # Cards due within the next hour are counted by minute, as in Box.move_learned_until
+        epoch, now = models.to_epoch(card.learned_until), models.to_epoch(datetime.datetime.now())
+        if epoch // 3600 > now // 3600 + 1:
+            self.learned_hours[epoch // 3600] = self.learned_hours.get(epoch // 3600, 0) + 1
+        elif epoch >= now:
+            self.learned_minutes[epoch // 60] = self.learned_minutes.get(epoch // 60, 0) + 1
+        return ([],[])
+        
+    def finish(self):
+        now = models.to_epoch(datetime.datetime.now())
+        learned_hours = dict((h, c) for (h, c) in self.learned_hours.iteritems() if h >= now // 3600)
+        learned_minutes = dict((m, c) for (m, c) in self.learned_minutes.iteritems() if m >= now // 60)
+        def txn():
+            box = models.Box.get(self.ancestor)
+            if box is not None:
+                box.set_counters(self.n_cards, learned_hours, learned_minutes)
+                box.put()
+        db.run_in_transaction(txn)
+        logging.info("Box %s has %d cards."%(self.ancestor, self.n_cards))
+
+
+### Factsheet Row Indexer ###
+
+def index_factsheet_rows(factsheet_key):
+    """ Writes a FactsheetRow for each changed row of the factsheet and
+        deletes removed ones, then marks the rows current for its revision.
+    """
+    BATCH_SIZE = 200
+    factsheet = models.Factsheet.get(factsheet_key)
+    if factsheet is None:
+        return
+    revision = factsheet.revision_number
+    rows = factsheet.rows()
+    existing = dict((r.key().name(), r) for r in models.FactsheetRow.all().ancestor(factsheet))
+    to_put = []
+    for row_key, values in rows.iteritems():
+        try:
+            data = simplejson.dumps(values, sort_keys=True)
+        except TypeError:
+            # Values YAML parsed as other types than strings (e.g. dates). The
+            # rows stay unindexed, so Factsheet.row() falls back to parsing.
+            logging.warning("Not indexing factsheet %s: row %s is not JSON serializable"%(factsheet.name, row_key))
+            return
+        if row_key not in existing or existing[row_key].data != data:
+            to_put.append(models.FactsheetRow(key_name=row_key, parent=factsheet, data=data))
+    to_delete = [r for (k, r) in existing.iteritems() if k not in rows]
+    logging.info("Indexing factsheet %s: %d rows changed, %d removed"%(factsheet.name, len(to_put), len(to_delete)))
+    
+    # Every write checks that the factsheet is still at this revision, so that
+    # a task for an older revision can't overwrite the rows of a newer one.
+    def txn(put=None, delete=None, index=False):
+        current = models.Factsheet.get(factsheet_key)
+        if current is None or current.revision_number != revision:
+            return False
+        if put:
+            db.put(put)
+        if delete:
+            db.delete(delete)
+        if index:
+            models.FactsheetRowIndex(key_name='index', parent=current, revision=revision).put()
+        return True
+    
+    for i in xrange(0, len(to_put), BATCH_SIZE):
+        if not db.run_in_transaction(txn, put=to_put[i:i+BATCH_SIZE]):
+            return
+    for i in xrange(0, len(to_delete), BATCH_SIZE):
+        if not db.run_in_transaction(txn, delete=to_delete[i:i+BATCH_SIZE]):
+            return
+    db.run_in_transaction(txn, index=True)
+    
+def index_all_factsheets():
+    for key in models.Factsheet.all(keys_only=True):
+        deferred.defer(index_factsheet_rows, str(key))
+
+
 ### Box Stats Creator ###
 
-def create_box_stats(for_box, days_back=10):
+def create_box_stats(for_box, days_back=10, only_missing=False):
+    """ Creates DailyBoxStats for the last days_back days with a single
+        pass over the cards in the box. If only_missing is set, days
+        that already have stats are skipped.
+    """
     logging.info("Creating stats for box %s"%(str(for_box)))
     if isinstance(for_box, basestring):
         for_box = db.Key(for_box)
-    for d in range(1, days_back + 1):
-        td = datetime.timedelta(days=d)
-        day = datetime.date.today() - td
-        mapper = BoxStatsMapper(day, ancestor=for_box)
-        deferred.defer(mapper.run)
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(days=d) for d in range(1, days_back + 1)]
+    if only_missing:
+        key_names = [models.DailyBoxStats.key_name_for(day) for day in days]
+        existing = models.DailyBoxStats.get_by_key_name(key_names, parent=for_box)
+        days = [day for (day, stats) in zip(days, existing) if stats is None]
+    if not days:
+        logging.info("No missing stats for box %s"%(str(for_box)))
+        return
+    mapper = BoxStatsMapper(days, ancestor=for_box)
+    deferred.defer(mapper.run)
         
 class BoxStatsMapper(Mapper):
-    
+    """ Computes the stats for all given days at once, reading each
+        card's history a single time.
+    """
     KIND = models.Card
     FILTERS = [('enabled',True)]
     QUEUE = 'boxstats'
+    KEYS_FIRST = True
     
-    def __init__(self, date, **kwds):
-        self.date = date
-        self.n_cards = 0
-        self.n_learned = 0
-        self.total_interval = 0
-        self.min_interval = 1000
-        self.max_interval = 0
-        self.intervals = [0]*12
-        #self.stats = str(stats.key())
+    def __init__(self, dates, **kwds):
+        self.dates = sorted(dates)
+        self.stats = dict((date, {'n_cards':0,
+                                  'n_learned':0,
+                                  'total_interval':0,
+                                  'min_interval':1000,
+                                  'max_interval':0,
+                                  'intervals':[0]*models.NUM_INTERVALS}) for date in self.dates)
         Mapper.__init__(self, **kwds)
         
     def map(self, card):
-        state = card.state_at(self.date)
-        iv = state['interval']
-        self.intervals[iv-1] += 1
-        self.min_interval = min(iv, self.min_interval)
-        self.max_interval = max(iv, self.max_interval)
-        if state['studied']:
-            self.n_cards += 1
-            self.total_interval += iv
-            if state['learned']:
-                self.n_learned += 1
-        return ([],[])
+        # Reading the history converts a legacy YAML one, which is written back once.
+        legacy = bool(card.history)
+        for date, state in card.states_at(self.dates).iteritems():
+            s = self.stats[date]
+            iv = state['interval']
+            s['intervals'][iv-1] += 1
+            s['min_interval'] = min(iv, s['min_interval'])
+            s['max_interval'] = max(iv, s['max_interval'])
+            if state['studied']:
+                s['n_cards'] += 1
+                s['total_interval'] += iv
+                if state['learned']:
+                    s['n_learned'] += 1
+        return ([card] if legacy else [],[])
     
     def finish(self):
-        date_string = self.date.strftime('%d-%m-%Y')
-        avg_interval = (self.total_interval / float(self.n_cards)) if self.n_cards > 0 else 0.0
-        stats = models.DailyBoxStats(key_name=date_string, 
-                                     parent=self.ancestor, 
-                                     day=self.date,
-                                     n_cards=self.n_cards,
-                                     n_learned=self.n_learned,
-                                     avg_interval=avg_interval,
-                                     intervals=self.intervals,
-                                     max_interval=self.max_interval,
-                                     min_interval=self.min_interval)
-        stats.put()
+        to_put = []
+        for date in self.dates:
+            s = self.stats[date]
+            avg_interval = (s['total_interval'] / float(s['n_cards'])) if s['n_cards'] > 0 else 0.0
+            to_put.append(models.DailyBoxStats(key_name=models.DailyBoxStats.key_name_for(date),
+                                               parent=self.ancestor,
+                                               day=date,
+                                               n_cards=s['n_cards'],
+                                               n_learned=s['n_learned'],
+                                               avg_interval=avg_interval,
+                                               intervals=s['intervals'],
+                                               max_interval=s['max_interval'],
+                                               min_interval=s['min_interval']))
+        db.put(to_put)
@@ -3,12 +3,17 @@
 # Python Imports
 import hashlib
 import logging
+import re
 
 # AppEngine imports
 from google.appengine.api import users
+from google.appengine.ext import db
 
 # Local Imports
-from models import Account, Box
+from models import Account, Box, StudyQueue, StudyQueueStamp
+
+# The study endpoints, which all read the box and its study queue
+RE_STUDY_PATH = re.compile(r'^/(?:box/([0-9]+)/(?:next_card|update_card)|mobile/box/([0-9]+)/study)')
 
 class AddUserToRequestMiddleware(object):
   """Add a user object and a user_is_admin flag to each request."""
@@ -18,6 +23,15 @@ class AddUserToRequestMiddleware(object):
         Depending on the value of require_login, it
         can return None as 'profile'.
     """
+    # Start fetching the box, its study queue and the queue's stamp for the study endpoints,
+    # so it is in flight together with the account query.
+    request.prefetch_rpc = None
+    study_match = RE_STUDY_PATH.match(request.path)
+    if study_match:
+        box_id = study_match.group(1) or study_match.group(2)
+        box_key = db.Key.from_path(Box.kind(), int(box_id))
+        request.prefetch_rpc = db.get_async([box_key, StudyQueue.key_for(box_key),
+                                             StudyQueueStamp.key_for(box_key)])
     #Get Google user_id
     google_user = users.get_current_user()
     account = None
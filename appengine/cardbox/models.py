@@ -11,10 +11,15 @@ import logging
 import base64
 import math
 import csv
+import struct
+import bisect
+import calendar
+import zlib
 
 # AppEngine Imports
 from google.appengine.ext import db
 from google.appengine.ext import deferred
+from google.appengine.api import memcache
 from google.appengine.ext.db import Key
 from google.appengine.ext.db import BadValueError, KindError
 
@@ -28,6 +33,7 @@ from django.core.urlresolvers import reverse
 
 # Library Imports
 import tools.diff_match_patch as dmp
+from tools.lru import LRUCache
 
 # Local Imports
 import draw
@@ -44,6 +50,14 @@ RESERVED_TITLES      = ['create','tags','list','edit','view','cardset','cardbox'
 VALID_CARDSET_TITLE  = r'^[a-z][\- a-z0-9]{4,49}$'
 VALID_FACTSHEET_NAME = r'^[a-z][\_a-z0-9]{4,49}$'
 
+PARSED_FACTSHEET_CACHE = LRUCache(max_size=20)
+REVISION_CACHE         = LRUCache(max_size=20)
+
+# A revision stores the full content instead of a patch every this many
+# edits, or when the patches since the last snapshot exceed this size.
+SNAPSHOT_EVERY       = 20
+SNAPSHOT_PATCH_BYTES = 100000
+
 ### Exceptions ###
 class FactsheetError(Exception):
     pass
@@ -94,6 +108,10 @@ class Revision(db.Model):
     editor = db.UserProperty(required=True)
     created = db.DateTimeProperty(auto_now_add=True)
     number = db.IntegerProperty(required=True)
+    # Content holds the full content of this revision instead of a patch.
+    snapshot = db.BooleanProperty(default=False)
+    # Content holds a row_delta (as JSON) instead of a text patch.
+    delta = db.BooleanProperty(default=False)
     
 class Factsheet(db.Model):
     content         = db.TextProperty(default='')
@@ -101,6 +119,11 @@ class Factsheet(db.Model):
     modified        = db.DateTimeProperty(auto_now=True)
     editor          = db.UserProperty(auto_current_user=True)
     revision_number = db.IntegerProperty(default=1)
+    # Numbers of the snapshot revisions, and the size of the patches since the last.
+    snapshot_numbers = db.ListProperty(int, indexed=False)
+    patch_bytes      = db.IntegerProperty(default=0, indexed=False)
+    # Whether content was written by set_columns_and_rows, so dump_table reproduces it.
+    canonical        = db.BooleanProperty(default=False, indexed=False)
         
     @classmethod
     def get_by_name(cls, name):
@@ -116,6 +139,9 @@ class Factsheet(db.Model):
         self._parsed      = None
         self._is_revision = is_revision
         self.new_content  = None
+        self._new_canonical = False
+        # {row_id: (FactsheetRow, FactsheetRowIndex)} fetched by Card.get_with_templates
+        self.prefetched_rows = {}
     
     @property
     def url(self):
@@ -144,6 +170,8 @@ class Factsheet(db.Model):
     def set_columns_and_rows(self, columns, rows):
         self.parse(columns, rows)
         self.new_content = yaml.safe_dump({'columns':columns, 'rows':rows})
+        # Rows are kept as dicts by column, which drops repeated columns.
+        self._new_canonical = len(set(columns)) == len(columns)
         
     def parse(self, columns=[], rows=[]):
         row_dict  = {}
@@ -168,20 +196,68 @@ class Factsheet(db.Model):
         if not self._parsed:
             if self.content == '':
                 self.parse()
-            else:
+            elif self._is_revision or not self.is_saved():
                 yaml_obj = yaml.safe_load(self.content)
                 self.parse(yaml_obj['columns'], yaml_obj['rows'])
+            else:
+                self._parsed = self.cached_parsed()
         return self._parsed
+        
+    def parsed_cache_key(self):
+        return 'factsheet-parsed-%s-%d'%(self.key(), self.revision_number)
+        
+    def cached_parsed(self):
+        """ Returns the parsed content for the current revision, from the
+            instance cache or memcache if possible. Memcache holds only the
+            columns and a list of row values, to keep it compact.
+        """
+        cache_key = self.parsed_cache_key()
+        parsed = PARSED_FACTSHEET_CACHE.get(cache_key)
+        if parsed is not None:
+            return parsed
+        compact = memcache.get(cache_key)
+        if compact is not None:
+            columns, order, values = compact
+            parsed = {'rows':dict((k, dict(zip(columns, v))) for (k, v) in zip(order, values)),
+                      'order':order,
+                      'columns':columns}
+        else:
+            yaml_obj = yaml.safe_load(self.content)
+            self.parse(yaml_obj['columns'], yaml_obj['rows'])
+            parsed  = self._parsed
+            columns = parsed['columns']
+            values  = [[parsed['rows'][k][c] for c in columns] for k in parsed['order']]
+            try:
+                memcache.set(cache_key, (columns, parsed['order'], values))
+            except ValueError:
+                logging.info("Parsed factsheet %s too large for memcache"%self.name)
+        PARSED_FACTSHEET_CACHE.set(cache_key, parsed)
+        return parsed
     
     def save(self):
         """ Modifies the content of page, creates rev if necessary. 
         """
-        def txn(factsheet, new_content, patch):
-            r = Revision(parent=factsheet,
-                         editor=factsheet.editor,
-                         content=patch,
-                         number=factsheet.revision_number)
+        def txn(factsheet, new_content, canonical, patch, is_delta):
+            number = factsheet.revision_number
+            last_snapshot = factsheet.snapshot_numbers[-1] if factsheet.snapshot_numbers else 0
+            if (number - last_snapshot >= SNAPSHOT_EVERY or 
+                factsheet.patch_bytes + len(patch) > SNAPSHOT_PATCH_BYTES):
+                r = Revision(parent=factsheet,
+                             editor=factsheet.editor,
+                             content=factsheet.content,
+                             number=number,
+                             snapshot=True)
+                factsheet.snapshot_numbers.append(number)
+                factsheet.patch_bytes = 0
+            else:
+                r = Revision(parent=factsheet,
+                             editor=factsheet.editor,
+                             content=patch,
+                             number=number,
+                             delta=is_delta)
+                factsheet.patch_bytes += len(patch)
             factsheet.content = new_content
+            factsheet.canonical = canonical
             factsheet.revision_number += 1
             r.put()
             factsheet.put()
@@ -189,34 +265,103 @@ class Factsheet(db.Model):
         if self._is_revision:
             raise Exception("Cannot save revision.")
         if self.content != '' and self.content != self.new_content:
-            differ = dmp.diff_match_patch()
-            patch = differ.patch_toText(differ.patch_make(self.new_content, self.content))
-            db.run_in_transaction(txn, self, self.new_content, patch)
+            patch = self.reverse_delta()
+            is_delta = patch is not None
+            if not is_delta:
+                differ = dmp.diff_match_patch()
+                patch = differ.patch_toText(differ.patch_make(self.new_content, self.content))
+            db.run_in_transaction(txn, self, self.new_content, self._new_canonical, patch, is_delta)
             logging.info("Created new revision (%d) for factsheet %s"%(self.revision_number,self.name))
         else:
             self.content = self.new_content
+            self.canonical = self._new_canonical
             self.put()
+        from engine import index_factsheet_rows
+        deferred.defer(index_factsheet_rows, str(self.key()))
+
+    def table(self):
+        """ Returns the parsed content as (columns, order, {row_id: values}).
+        """
+        columns = self.columns()
+        rows    = self.rows()
+        return (columns, self.row_order(), 
+                dict((k, [r[c] for c in columns]) for (k, r) in rows.iteritems()))
+        
+    def reverse_delta(self):
+        """ Returns the row_delta from the new content back to the stored 
+            content as JSON, or None if a text patch is needed: when the
+            stored content was not written by set_columns_and_rows, so
+            dumping its rows would not reproduce it, or when its values
+            are not JSON serializable (e.g. dates parsed by YAML).
+        """
+        new_parsed = self._parsed
+        if new_parsed is None or self.new_content is None or not self.canonical:
+            return None
+        self._parsed = self.cached_parsed()
+        old_table    = self.table()
+        self._parsed = new_parsed
+        try:
+            return simplejson.dumps(row_delta(old_table, self.table()))
+        except TypeError:
+            return None
 
     def revision(self, number):
-        """ Returns a given revision
+        """ Returns a given revision. Patches are applied starting from the
+            first snapshot after it, or from the current content if there
+            is none.
         """
         if self._is_revision:
             raise Exception("Cannot get revision of revision.")
+        cache_key = 'factsheet-revision-%s-%d'%(self.key(), number)
+        cached = REVISION_CACHE.get(cache_key) or memcache.get(cache_key)
+        if cached is None:
+            cached = self.reconstruct_revision(number)
+            try:
+                memcache.set(cache_key, cached)
+            except ValueError:
+                logging.info("Revision %d of factsheet %s too large for memcache"%(number, self.name))
+        REVISION_CACHE.set(cache_key, cached)
+        revised_content, editor, created, number = cached
+        revised_page = self.__class__(key_name=self.key().name(),
+                                      content=revised_content,
+                                      editor=editor,
+                                      modified=created,
+                                      number=number,
+                                      is_revision=True)
+        return revised_page
+        
+    def reconstruct_revision(self, number):
+        """ Returns (content, editor, created, number) of a revision. 
+        """
         differ = dmp.diff_match_patch()
         history = Revision.all().ancestor(self)
         history.filter('number >=',number).order('-number')
-        revised_content = self.content
+        i = bisect.bisect_left(self.snapshot_numbers, number)
+        if i < len(self.snapshot_numbers):
+            history.filter('number <=',self.snapshot_numbers[i])
+        # Deltas apply to the parsed table, patches to the text, so
+        # only one of the two is kept at a time.
+        revised_content, table = self.content, None
         for r in history:
-            patch = differ.patch_fromText(unicode(r.content))
-            revised_content = differ.patch_apply(patch, revised_content)[0]
+            if r.snapshot:
+                revised_content, table = r.content, None
+            elif r.delta:
+                if table is None:
+                    if revised_content is self.content:
+                        table = self.table()
+                    else:
+                        table = Factsheet(content=revised_content, is_revision=True).table()
+                table = apply_row_delta(table, simplejson.loads(r.content))
+                revised_content = None
+            else:
+                if revised_content is None:
+                    revised_content, table = dump_table(table), None
+                patch = differ.patch_fromText(unicode(r.content))
+                revised_content = differ.patch_apply(patch, revised_content)[0]
             earliest = r
-        revised_page = self.__class__(key_name=self.key().name(),
-                                      content=revised_content,
-                                      editor=earliest.editor,
-                                      modified=earliest.created,
-                                      number=earliest.number,
-                                      is_revision=True)
-        return revised_page
+        if revised_content is None:
+            revised_content = dump_table(table)
+        return (revised_content, earliest.editor, earliest.created, earliest.number)
         
     def row_order(self):
         return self.parsed().get('order',[])
@@ -229,6 +374,42 @@ class Factsheet(db.Model):
         
     def rows(self):
         return self.parsed()['rows']
+        
+    def row(self, row_id):
+        """ Returns a single row. If the content isn't parsed yet, and the
+            FactsheetRows are up to date, only that row is fetched and decoded.
+        """
+        if self._parsed or self._is_revision or self.parsed_cache_key() in PARSED_FACTSHEET_CACHE:
+            return self.rows().get(row_id, None)
+        if row_id in self.prefetched_rows:
+            row, index = self.prefetched_rows[row_id]
+        else:
+            row, index = db.get([FactsheetRow.key_for(self.key(), row_id),
+                                 FactsheetRowIndex.key_for(self.key())])
+        if index is None or index.revision != self.revision_number:
+            return self.rows().get(row_id, None)
+        return row.values() if row is not None else None
+
+
+class FactsheetRow(db.Model):
+    """ A single row of the parent factsheet, keyed by row key. """
+    data = db.TextProperty()
+    
+    @classmethod
+    def key_for(cls, factsheet_key, row_id):
+        return db.Key.from_path(cls.kind(), row_id, parent=factsheet_key)
+    
+    def values(self):
+        return simplejson.loads(self.data)
+        
+
+class FactsheetRowIndex(db.Model):
+    """ Revision of the parent factsheet that its FactsheetRows match. """
+    revision = db.IntegerProperty(default=0)
+    
+    @classmethod
+    def key_for(cls, factsheet_key):
+        return db.Key.from_path(cls.kind(), 'index', parent=factsheet_key)
 
 
 class Cardset(db.Model):
@@ -308,18 +489,48 @@ class Box(db.Model):
     cardsets     = db.ListProperty(int)
     last_studied = db.DateTimeProperty(default=datetime.datetime(2010,1,1))
     time_studied = TimeDeltaProperty(default=datetime.timedelta(0))
+    # Denormalized counters, None until first counted by engine.reconcile_box_counters
+    n_cards        = db.IntegerProperty()
+    # Histogram of the (future) learned_until of enabled cards, by epoch hour
+    learned_hours  = db.ListProperty(int, indexed=False)
+    learned_counts = db.ListProperty(int, indexed=False)
+    # The same by epoch minute, for cards that were due within the next hour
+    # when they were counted, which are not in the hourly histogram.
+    learned_minutes       = db.ListProperty(int, indexed=False)
+    learned_minute_counts = db.ListProperty(int, indexed=False)
     
     def update_cards(self):
         from engine import update_cards
         update_cards(self.all_card_ids(), self.key())
     
-    def update_time_studied(self):
+    def update_time_studied(self, put=True):
         now = datetime.datetime.now()
         diff = (now - self.last_studied)
         if diff.seconds < 300:
             self.time_studied += diff
         self.last_studied = now
-        self.put()
+        if put:
+            self.put()
+            
+    def answer_cards(self, answers, queue=None):
+        """ Applies a list of (card, correct) answers and writes the cards,
+            the StudyQueue and the box itself with a single batch put.
+            The queue can be passed in if it was already fetched.
+        """
+        if queue is None:
+            queue = StudyQueue.get(StudyQueue.key_for(self))
+        to_put = []
+        for card, correct in answers:
+            card.apply_answer(correct, self)
+            if queue is not None:
+                queue.update(card)
+            if card not in to_put:
+                to_put.append(card)
+        self.update_time_studied(put=False)
+        to_put.append(self)
+        if queue is not None:
+            to_put.append(queue)
+        db.put(to_put)
         
     def fetch_cardsets(self):
         return Cardset.get_by_id(self.cardsets)
@@ -336,11 +547,62 @@ class Box(db.Model):
         logging.info("Card (i: %d, lc: %s) rescheduled to %s"%(interval, last_correct, learned_until))
         return learned_until.replace(microsecond=0)
         
+    def move_learned_until(self, old, new):
+        """ Moves one card from the histogram bucket of learned_until old
+            to that of new. Either can be None to only add or remove.
+        """
+        now = to_epoch(datetime.datetime.now())
+        now_hour, now_minute = now // 3600, now // 60
+        if old is not None and to_epoch(old) // 3600 >= now_hour:
+            # It was counted by minute if it was due soon when it was counted.
+            if not move_bucket(self.learned_minutes, self.learned_minute_counts, to_epoch(old) // 60, -1):
+                move_bucket(self.learned_hours, self.learned_counts, to_epoch(old) // 3600, -1)
+        if new is not None and to_epoch(new) // 3600 >= now_hour:
+            if to_epoch(new) // 3600 <= now_hour + 1:
+                move_bucket(self.learned_minutes, self.learned_minute_counts, to_epoch(new) // 60, 1)
+            else:
+                move_bucket(self.learned_hours, self.learned_counts, to_epoch(new) // 3600, 1)
+        # Drop buckets that have expired
+        i = bisect.bisect_left(self.learned_hours, now_hour)
+        del self.learned_hours[:i]
+        del self.learned_counts[:i]
+        i = bisect.bisect_left(self.learned_minutes, now_minute)
+        del self.learned_minutes[:i]
+        del self.learned_minute_counts[:i]
+        
+    def set_counters(self, n_cards, learned_hours, learned_minutes):
+        """ Overwrites the counters, learned_hours and learned_minutes are 
+            dicts of {hour: count} and {minute: count}.
+        """
+        self.n_cards        = n_cards
+        self.learned_hours  = sorted(learned_hours.keys())
+        self.learned_counts = [learned_hours[h] for h in self.learned_hours]
+        self.learned_minutes       = sorted(learned_minutes.keys())
+        self.learned_minute_counts = [learned_minutes[m] for m in self.learned_minutes]
+        
     def stats(self):
         if not hasattr(self, '_stats') or self._stats is None:
-            n_cards = len(list(self.all_card_ids()))
-            now = datetime.datetime.now()
-            n_learned = Card.all().ancestor(self).filter('enabled',True).filter('learned_until >', now).count(n_cards)
+            if self.n_cards is not None:
+                n_cards = self.n_cards
+                now = to_epoch(datetime.datetime.now())
+                now_hour, now_minute = now // 3600, now // 60
+                n_learned = 0
+                for (h, c) in zip(self.learned_hours, self.learned_counts):
+                    if h > now_hour:
+                        n_learned += c
+                    elif h == now_hour:
+                        # Cards counted long before their hour, assumed to
+                        # come due evenly over it.
+                        n_learned += c * (3600 - now % 3600) // 3600
+                n_learned += sum(c for (m, c) in zip(self.learned_minutes, self.learned_minute_counts) if m >= now_minute)
+            else:
+                if memcache.add('box-reconcile-%s'%self.key(), True, time=600):
+                    from engine import reconcile_box_counters
+                    deferred.defer(reconcile_box_counters, str(self.key()))
+                n_cards = len(list(self.all_card_ids()))
+                now = datetime.datetime.now()
+                n_learned = Card.all().ancestor(self).filter('enabled',True).filter('learned_until >', now).count(n_cards)
+            n_learned = min(n_learned, n_cards)
             percentage = (n_learned/float(n_cards))*100.0 if n_cards > 0 else 0.0
             self._stats = {'percent_learned':percentage,'n_learned':n_learned,'n_cards':n_cards}
         return self._stats
@@ -367,7 +629,7 @@ class Box(db.Model):
             recentstats = DailyBoxStats.all().ancestor(self).order('-day').filter('day >',recent)
             if recentstats.count(limit=1) < 1:
                 from engine import create_box_stats
-                create_box_stats(self, days_back=40)
+                create_box_stats(self, days_back=40, only_missing=True)
             stats = DailyBoxStats.all().ancestor(self).order('day').fetch(limit=60)
             data = [(s.day, s.n_cards, s.n_learned, s.min_interval, s.max_interval, s.avg_interval) for s in stats]
             (dates, n_cards, n_learned, min_interval, max_interval, avg_interval) = (zip(*data) if len(data) > 0 else
@@ -393,31 +655,58 @@ class Box(db.Model):
         study_set.filter('enabled',True)
         return list(study_set.fetch(self.study_set_size))
         
-    def card_to_study(self):
-        study_set = self.study_set()
+    def card_to_study(self, queue=None, stamp=None):
+        return self.cards_to_study(1, queue=queue, stamp=stamp)[0]
+        
+    def cards_to_study(self, n, queue=None, stamp=None, rebuilt=False):
+        """ Picks the next n cards to study from the box's StudyQueue,
+            refilling the study set if needed. The cards, the cards added
+            to the study set, and the queue are written back with a single
+            batch put. The queue and its StudyQueueStamp can be passed in 
+            if they were already fetched together.
+        """
+        if queue is None:
+            queue, stamp = db.get([StudyQueue.key_for(self), StudyQueueStamp.key_for(self)])
+        generation = StudyQueueStamp.generation_of(stamp)
+        if queue is None or queue.generation != generation:
+            # Not rebuilt by its task yet, build it here.
+            queue, rebuilt = StudyQueue.rebuild(self, generation), True
+        elif queue.needs_extend():
+            queue.extend(self)
+        now = to_epoch(datetime.datetime.now())
+        study_set = queue.study_set()
         # Add cards to the 'study set', a subset to focus on.
+        refill = []
         if len(study_set) < self.study_set_size/2:
-            available = Card.all().ancestor(self)
-            available.filter('enabled',True)
-            available.filter('learned_until <', datetime.datetime.now())
-            available.filter('in_study_set', False)
-            available = list(available.fetch(self.study_set_size * 10))
+            available = queue.available(now, self.study_set_size * 10)
             logging.info("available cards: %d"%len(available))
-            # available = filter(lambda x: not x.in_study_set, available)
-            
             refill = random.sample(available,min(len(available),self.study_set_size))
-            for c in refill:
-                c.in_study_set = True
-                c.put()
+            queue.add_to_study_set(refill)
             study_set.extend(refill)
-        #Return one of first available cards.
-        if len(study_set) == 0:
-            next_unlearned = Card.all().ancestor(self).order('learned_until').filter('enabled',True)
-            return random.choice(next_unlearned.fetch(limit=20))
-        study_set.sort(key=lambda x: x.last_studied)
-        next_card = random.choice(study_set[:len(study_set)//2+1])
-        next_card.studied()
-        return next_card
+        # Prefer the least recently studied half of the study set, then the
+        # rest of it, then the first available cards.
+        study_set.sort(key=queue.last_studied_of)
+        half = len(study_set)//2+1
+        candidates = random.sample(study_set[:half], len(study_set[:half])) + study_set[half:]
+        first_available = [c for c in queue.card_names[:20] if c not in candidates]
+        candidates += random.sample(first_available, len(first_available))
+        names = candidates[:n]
+        cards = Card.get_with_templates(names, parent=self)
+        refill_names = [name for name in refill if name not in names]
+        refill_cards = Card.get_by_key_name(refill_names, parent=self) if refill_names else []
+        if None in cards + refill_cards or not all(c.enabled for c in cards + refill_cards):
+            if rebuilt:
+                raise Exception("Card in rebuilt StudyQueue not found.")
+            logging.info("StudyQueue of %s is stale, rebuilding."%self.key())
+            return self.cards_to_study(n, queue=StudyQueue.rebuild(self, generation), stamp=stamp, rebuilt=True)
+        for card in refill_cards:
+            card.in_study_set = True
+        for card in cards:
+            card.in_study_set = queue.in_study_set_of(card.key().name())
+            card.studied(put=False)
+            queue.update(card)
+        db.put(cards + refill_cards + [queue])
+        return cards
     
     def all_card_ids(self):
         output = []
@@ -442,12 +731,16 @@ class Card(db.Model):
     interval      = db.IntegerProperty(default=1)
     n_correct     = db.IntegerProperty(default=0)
     n_wrong       = db.IntegerProperty(default=0)
-    history       = db.TextProperty(default='')
+    history       = db.TextProperty(default='') # Legacy YAML log, see packed_history
+    packed_history = db.BlobProperty(default='')
     
     def answered(self, correct=False):
         """ Update the card with correct/wrong stats."""
+        self.parent().answer_cards([(self, correct)])
+        
+    def apply_answer(self, correct, box):
+        """ Updates the stats and history for an answer, without writing. """
         now = datetime.datetime.now().replace(microsecond=0)
-        box = self.parent()
         self.last_studied = now
         if correct:
             self.last_correct = now
@@ -458,19 +751,63 @@ class Card(db.Model):
             self.n_wrong += 1
             self.interval -= 1
         self.interval = min(NUM_INTERVALS,max(1, self.interval))
+        learned_until = self.learned_until
         self.learned_until =  box.reschedule_card(self)
-        log_line = yaml.dump([[now,
-                               int(self.n_correct), 
-                               int(self.n_wrong), 
-                               int(self.interval),
-                               self.learned_until]])
-        self.history += log_line
-        self.put()
-        box.update_time_studied()
-        
-    def studied(self):
+        if self.enabled:
+            box.move_learned_until(learned_until, self.learned_until)
+        self.get_history().append(now, 
+                                  self.n_correct, 
+                                  self.n_wrong, 
+                                  self.interval,
+                                  self.learned_until)
+        self.packed_history = db.Blob(self.get_history().data)
+        
+    def studied(self, put=True):
         self.last_studied = datetime.datetime.now().replace(microsecond=0)
-        self.put()
+        if put:
+            self.put()
+        
+    @classmethod
+    def get_with_templates(cls, key_names, parent):
+        """ Gets the cards with the given key names, and everything needed to
+            render them: their cardsets in the same batch get, then their
+            factsheets and rows in a second one.
+        """
+        card_keys    = [db.Key.from_path(cls.kind(), name, parent=parent.key()) for name in key_names]
+        cardset_ids  = [int(name.split('-',1)[0]) for name in key_names]
+        cardset_keys = list(set(db.Key.from_path(Cardset.kind(), i) for i in cardset_ids))
+        results  = db.get(card_keys + cardset_keys)
+        cards    = results[:len(card_keys)]
+        cardsets = dict(zip(cardset_keys, results[len(card_keys):]))
+        for card, cardset_id in zip(cards, cardset_ids):
+            if card is not None:
+                card._cardset_old = cardsets[db.Key.from_path(Cardset.kind(), cardset_id)]
+        # Factsheets, with their row index, and rows
+        factsheet_keys = {}
+        row_keys = []
+        for card in cards:
+            cardset = card and card._cardset_old
+            if cardset is None:
+                continue
+            factsheet_key = Cardset.factsheet.get_value_for_datastore(cardset)
+            if factsheet_key is None:
+                continue
+            factsheet_keys[factsheet_key] = FactsheetRowIndex.key_for(factsheet_key)
+            row_keys.append((factsheet_key, card.key().name().split('-',1)[1]))
+        keys = (factsheet_keys.keys() + factsheet_keys.values() + 
+                [FactsheetRow.key_for(k, row_id) for (k, row_id) in row_keys])
+        results = dict(zip(keys, db.get(keys))) if keys else {}
+        for factsheet_key, row_id in row_keys:
+            factsheet = results[factsheet_key]
+            if factsheet is not None:
+                factsheet.prefetched_rows[row_id] = (results[FactsheetRow.key_for(factsheet_key, row_id)],
+                                                     results[factsheet_keys[factsheet_key]])
+        for cardset in cardsets.values():
+            if cardset is not None:
+                factsheet_key = Cardset.factsheet.get_value_for_datastore(cardset)
+                if factsheet_key is not None and results.get(factsheet_key) is not None:
+                    cardset.factsheet = results[factsheet_key]
+        return cards
         
     def get_cardset(self):
         if not hasattr(self, '_cardset_old'):
@@ -480,19 +817,40 @@ class Card(db.Model):
     def is_learned(self):
         return self.learned_until > datetime.datetime.now()
         
+    def get_history(self):
+        """ Returns the CardHistory of this card. Converts a legacy YAML
+            history on first access; it is stored on the next put().
+        """
+        if not hasattr(self, '_history'):
+            self._history = CardHistory(self.packed_history)
+            if self.history:
+                legacy = CardHistory()
+                for entry in yaml.load(self.history) or []:
+                    legacy.append(*entry)
+                self._history = CardHistory(legacy.data + self._history.data)
+                self.packed_history = db.Blob(self._history.data)
+                self.history = ''
+        return self._history
+        
     def state_at(self, date):
-        dt = datetime.datetime.combine(date, datetime.time(0))
-        last_state = {'learned':False,'studied':False,'interval':1}
-        history = yaml.load(self.history)
-        if history: 
-            for entry in history:
-                if dt > entry[0]:
-                    last_state = {
-                        'interval':entry[3],
-                        'learned':dt < entry[4],
-                        'studied':True
-                    }
-        return last_state
+        return self.states_at([date])[date]
+        
+    def states_at(self, dates):
+        """ Returns a dict of {date: state} for all given dates. """
+        history = self.get_history()
+        states  = {}
+        for date in dates:
+            dt = datetime.datetime.combine(date, datetime.time(0))
+            entry = history.entry_before(dt)
+            if entry is None:
+                states[date] = {'learned':False,'studied':False,'interval':1}
+            else:
+                states[date] = {
+                    'interval':entry[3],
+                    'learned':dt < entry[4],
+                    'studied':True
+                }
+        return states
         
     def template(self):
         if not hasattr(self, '_template'):
@@ -500,12 +858,12 @@ class Card(db.Model):
             mapping        = self.get_cardset().get_mapping()
             template_name  = self.get_cardset().get_template_name()
             row_id         = self.key().name().split('-',1)[1]
-            row            = factsheet.rows().get(row_id,None)
             self._template = CardTemplate()
             if factsheet is None:
                 self._template.error = "List not found or empty."
                 logging.error("Factsheet(%s) was not found from Card(%s)"%(self.get_cardset().title, self.key().name()))
                 return self._template
+            row = factsheet.row(row_id)
             if row is None:
                 self._template.error = "Card not found in list."
                 logging.error("Row(%s) was not found in Factsheet(%s) from card(%s). "%(row_id, factsheet.name, self.key().name()))
@@ -528,6 +886,194 @@ class Card(db.Model):
         pass
         
 
+class StudyQueue(db.Model):
+    """ Schedule of the earliest due enabled cards in the parent box, and 
+        its study set, ordered by learned_until, so the next card can be 
+        picked without queries. Times are stored as epoch seconds in lists
+        parallel to card_names.
+        
+        Cards are loaded LOAD_SIZE at a time from a learned_until ordered
+        query, continued from cursor. Every enabled card that is not in the
+        queue is due no earlier than horizon, the learned_until of the last
+        loaded card, so cards that are rescheduled past it are dropped and
+        found again by the query. Complete is set when the query ran out. 
+        Deleted (and rebuilt from a task) whenever the box's cards change.
+        A queue whose generation is not that of the box's StudyQueueStamp
+        was written back by a request that read it before that, and is
+        rebuilt as well.
+    """
+    KEY_NAME  = 'queue'
+    LOAD_SIZE = 200
+    # Loads more cards when fewer than this are queued outside the study set.
+    MIN_SIZE  = 50
+    
+    card_names    = db.StringListProperty(indexed=False)
+    learned_until = db.ListProperty(int, indexed=False)
+    last_studied  = db.ListProperty(int, indexed=False)
+    in_study_set  = db.ListProperty(bool, indexed=False)
+    cursor        = db.TextProperty()
+    horizon       = db.IntegerProperty(indexed=False)
+    complete      = db.BooleanProperty(default=False, indexed=False)
+    generation    = db.IntegerProperty(default=0, indexed=False)
+    
+    @classmethod
+    def key_for(cls, box):
+        if isinstance(box, db.Model):
+            box = box.key()
+        return db.Key.from_path(cls.kind(), cls.KEY_NAME, parent=box)
+        
+    @classmethod
+    def rebuild(cls, box, generation):
+        """ Returns a new queue with the box's study set and the first
+            LOAD_SIZE cards by learned_until. 
+        """
+        queue = cls(key_name=cls.KEY_NAME, parent=box, generation=generation)
+        study_set = Card.all().ancestor(box).filter('in_study_set',True).filter('enabled',True)
+        for card in study_set.fetch(Box.study_set_size * 2):
+            queue.update(card)
+        queue.extend(box)
+        return queue
+        
+    @classmethod
+    def invalidate(cls, box):
+        """ Deletes the queue and rebuilds it from a task. """
+        if isinstance(box, db.Model):
+            box = box.key()
+        def txn():
+            stamp = StudyQueueStamp.get(StudyQueueStamp.key_for(box))
+            if stamp is None:
+                stamp = StudyQueueStamp(key_name=StudyQueueStamp.KEY_NAME, parent=box)
+            stamp.generation += 1
+            db.put(stamp)
+            db.delete(cls.key_for(box))
+        db.run_in_transaction(txn)
+        from engine import rebuild_study_queue
+        deferred.defer(rebuild_study_queue, str(box))
+        
+    def needs_extend(self):
+        return (not self.complete and 
+                self.in_study_set.count(False) < self.MIN_SIZE)
+        
+    def extend(self, box):
+        """ Loads the next LOAD_SIZE cards from the query. """
+        query = Card.all().ancestor(box).filter('enabled',True).order('learned_until')
+        if self.cursor:
+            query.with_cursor(self.cursor)
+        cards = query.fetch(self.LOAD_SIZE)
+        if len(cards) < self.LOAD_SIZE:
+            self.complete = True
+            self.cursor   = None
+            self.horizon  = None
+        else:
+            self.cursor  = query.cursor()
+            self.horizon = to_epoch(cards[-1].learned_until)
+        for card in cards:
+            if self.index_of(card.key().name()) is None:
+                self.update(card)
+        
+    def index_of(self, name):
+        try:
+            return self.card_names.index(name)
+        except ValueError:
+            return None
+    
+    def update(self, card):
+        """ Sets the queue entry of card to its current state. Cards that
+            are disabled, or due after the horizon, are dropped. 
+        """
+        name = card.key().name()
+        i = self.index_of(name)
+        if i is not None:
+            for l in (self.card_names, self.learned_until, self.last_studied, self.in_study_set):
+                del l[i]
+        learned_until = to_epoch(card.learned_until)
+        if not card.enabled:
+            return
+        if (not self.complete and not card.in_study_set and
+            self.horizon is not None and learned_until > self.horizon):
+            return
+        i = bisect.bisect_right(self.learned_until, learned_until)
+        self.card_names.insert(i, name)
+        self.learned_until.insert(i, learned_until)
+        self.last_studied.insert(i, to_epoch(card.last_studied))
+        self.in_study_set.insert(i, bool(card.in_study_set))
+        
+    def study_set(self):
+        return [n for (n, s) in zip(self.card_names, self.in_study_set) if s]
+        
+    def available(self, now, limit):
+        """ Returns the names of cards due before now, not in the study set. """
+        names = []
+        for i in xrange(len(self.card_names)):
+            if self.learned_until[i] >= now or len(names) >= limit:
+                break
+            if not self.in_study_set[i]:
+                names.append(self.card_names[i])
+        return names
+        
+    def add_to_study_set(self, names):
+        for name in names:
+            self.in_study_set[self.index_of(name)] = True
+            
+    def in_study_set_of(self, name):
+        return self.in_study_set[self.index_of(name)]
+        
+    def last_studied_of(self, name):
+        return self.last_studied[self.index_of(name)]
+
+
+class StudyQueueStamp(db.Model):
+    """ Generation of the parent box's StudyQueue, counted up by each
+        invalidation. Kept apart from the Box and the queue, which requests
+        write back without transactions.
+    """
+    KEY_NAME   = 'stamp'
+    generation = db.IntegerProperty(default=0, indexed=False)
+    
+    @classmethod
+    def key_for(cls, box):
+        if isinstance(box, db.Model):
+            box = box.key()
+        return db.Key.from_path(cls.kind(), cls.KEY_NAME, parent=box)
+        
+    @classmethod
+    def generation_of(cls, stamp):
+        return stamp.generation if stamp is not None else 0
+
+
+class JobPayload(db.Model):
+    """ Input of a background job that is too large to pickle into every
+        task. Holds a list of strings, zlib compressed. Key name is the job id.
+    """
+    data = db.BlobProperty()
+    
+    @classmethod
+    def save(cls, job_id, strings):
+        data = zlib.compress('\n'.join(strings).encode('utf-8'))
+        cls(key_name=job_id, data=db.Blob(data)).put()
+        
+    @classmethod
+    def load(cls, job_id):
+        payload = cls.get_by_key_name(job_id)
+        if payload is None:
+            raise Exception("Payload for job %s not found."%job_id)
+        data = zlib.decompress(payload.data).decode('utf-8')
+        return data.split('\n') if data else []
+        
+    @classmethod
+    def remove(cls, job_id):
+        db.delete(db.Key.from_path(cls.kind(), job_id))
+
+
+class MapperJob(db.Model):
+    """ Tracks the shards of a sharded engine.Mapper run. Key name is the
+        job id. Finished shards add their index and pickled state.
+    """
+    shards      = db.IntegerProperty(required=True)
+    done_shards = db.ListProperty(int, indexed=False)
+    states      = db.ListProperty(db.Blob)
+
+
 class DailyBoxStats(db.Model):
     """ Keeps track of daily stats for parent box. """
     day          = db.DateProperty()
@@ -537,6 +1083,10 @@ class DailyBoxStats(db.Model):
     avg_interval = db.FloatProperty(default=1.0)
     min_interval = db.IntegerProperty(default=1)
     max_interval = db.IntegerProperty(default=1)
+    
+    @classmethod
+    def key_name_for(cls, day):
+        return day.strftime('%d-%m-%Y')
 
 
 ### Non-model Classes ###
@@ -554,22 +1104,48 @@ class CardTemplate(object):
         if mapping is not None:
             self.set_mapping(mapping)
 
+    # Parsed templates by name, shared by all instances: {name: (mtime, parsed)}
+    _cache = {}
+
     def load(self,template_name):
+        self.template_name = template_name
         try:
-            self.template_name   = template_name
-            self.template_string = open('templates/cards/'+template_name+'.html').read()
-            self.template        = django_template.Template(self.template_string)
-            self.front_fields    = set(RE_DJANGO_VARIABLE_TAG.findall(RE_CARD_FRONT.findall(self.template_string)[0]))
-            self.back_fields     = set(RE_DJANGO_VARIABLE_TAG.findall(RE_CARD_BACK.findall(self.template_string)[0]))
-            self.fields          = self.front_fields | self.back_fields
-            self.front_fields    = sorted(self.front_fields,key=lambda v: v[-1])
-            self.back_fields     = sorted(self.back_fields,key=lambda v: v[-1])
-            self.back_fields     = [f for f in self.back_fields if f not in self.front_fields]
+            parsed = self.load_parsed(template_name)
+            self.template_string = parsed['template_string']
+            self.template        = parsed['template']
+            self.fields          = parsed['fields']
+            self.front_fields    = parsed['front_fields']
+            self.back_fields     = parsed['back_fields']
             self.error           = False
-        except IOError:
+        except (IOError, OSError):
             self.error           = "Template not found."
             self.template_string = None
 
+    @classmethod
+    def load_parsed(cls, template_name):
+        """ Returns the compiled template and its fields, reading and
+            compiling the file only if it changed since it was cached.
+        """
+        path  = 'templates/cards/'+template_name+'.html'
+        mtime = os.path.getmtime(path)
+        cached = cls._cache.get(template_name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        template_string = open(path).read()
+        front_fields    = set(RE_DJANGO_VARIABLE_TAG.findall(RE_CARD_FRONT.findall(template_string)[0]))
+        back_fields     = set(RE_DJANGO_VARIABLE_TAG.findall(RE_CARD_BACK.findall(template_string)[0]))
+        fields          = front_fields | back_fields
+        front_fields    = sorted(front_fields,key=lambda v: v[-1])
+        back_fields     = sorted(back_fields,key=lambda v: v[-1])
+        back_fields     = [f for f in back_fields if f not in front_fields]
+        parsed = {'template_string':template_string,
+                  'template':django_template.Template(template_string),
+                  'fields':frozenset(fields),
+                  'front_fields':tuple(front_fields),
+                  'back_fields':tuple(back_fields)}
+        cls._cache[template_name] = (mtime, parsed)
+        return parsed
+
     def set_mapping(self,mapping):
         self.mapping    = mapping
         self.front_vars = [mapping[f] for f in self.front_fields if f in mapping]
@@ -610,6 +1186,50 @@ class CardTemplate(object):
         
 
 
+class CardHistory(object):
+    """ Append-only log of a card's answers, packed as fixed-width records
+        of (time, n_correct, n_wrong, interval, learned_until). Times are
+        stored as epoch seconds, so entries can be found by bisection.
+    """
+    RECORD = struct.Struct('<IHHBI')
+    
+    def __init__(self, data=''):
+        self.data = str(data or '')
+        
+    def __len__(self):
+        return len(self.data) // self.RECORD.size
+        
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        (t, n_correct, n_wrong, interval, learned_until) = self.RECORD.unpack_from(self.data, i * self.RECORD.size)
+        return [from_epoch(t), n_correct, n_wrong, interval, from_epoch(learned_until)]
+        
+    def time_at(self, i):
+        return self.RECORD.unpack_from(self.data, i * self.RECORD.size)[0]
+        
+    def append(self, time, n_correct, n_wrong, interval, learned_until):
+        self.data += self.RECORD.pack(to_epoch(time),
+                                      min(int(n_correct), 0xFFFF),
+                                      min(int(n_wrong), 0xFFFF),
+                                      min(int(interval), 0xFF),
+                                      to_epoch(learned_until))
+        
+    def entry_before(self, dt):
+        """ Returns the last entry strictly before dt, or None. """
+        t = to_epoch(dt)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self[lo - 1] if lo > 0 else None
+
+
 ### Helper Functions ###
 
 def title_to_name(title):
@@ -622,6 +1242,74 @@ def name_to_title(name):
     nm = ' '.join([w.capitalize() for w in name.split('_')])
     return nm
     
+def dump_table(table):
+    """ Returns factsheet content for a (columns, order, {row_id: values}) 
+        table, as Factsheet.set_columns_and_rows writes it.
+    """
+    columns, order, values = table
+    return yaml.safe_dump({'columns':columns, 'rows':[values[k] for k in order]})
+    
+def move_bucket(keys, counts, key, n):
+    """ Adds n to the count of key in a histogram kept as a sorted list of
+        keys and a list of counts. Counts don't go below zero, and a missing
+        key is only added for n > 0. Returns whether the count was changed.
+    """
+    i = bisect.bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key and counts[i] + n >= 0:
+        counts[i] += n
+        return True
+    if n > 0:
+        keys.insert(i, key)
+        counts.insert(i, n)
+        return True
+    return False
+    
+def row_delta(old, new):
+    """ Returns the changes that turn table new back into table old: 
+        {'rows': {row_id: old values, or None if the row is new}}, plus
+        'columns' if they changed, and either 'insert' [(index, row_id)] 
+        for rows that were removed, or the complete old 'order' if rows
+        were moved.
+    """
+    old_columns, old_order, old_values = old
+    new_columns, new_order, new_values = new
+    delta = {'rows':{}}
+    if old_columns != new_columns:
+        delta['columns'] = old_columns
+    for k, v in old_values.iteritems():
+        if new_values.get(k) != v:
+            delta['rows'][k] = v
+    for k in new_values:
+        if k not in old_values:
+            delta['rows'][k] = None
+    insert = [(i, k) for (i, k) in enumerate(old_order) if k not in new_values]
+    if _reorder(new_order, old_values, insert) != old_order:
+        delta['order'] = old_order
+    elif insert:
+        delta['insert'] = insert
+    return delta
+    
+def apply_row_delta(table, delta):
+    """ Applies a row_delta to a table. The table's row dict is modified. 
+    """
+    columns, order, values = table
+    for k, v in delta['rows'].iteritems():
+        if v is None:
+            values.pop(k, None)
+        else:
+            values[k] = v
+    if 'order' in delta:
+        order = delta['order']
+    else:
+        order = _reorder(order, values, delta.get('insert', []))
+    return (delta.get('columns', columns), order, values)
+    
+def _reorder(order, values, insert):
+    order = [k for k in order if k in values]
+    for i, k in insert:
+        order.insert(i, k)
+    return order
+    
 
 
 
@@ -637,6 +1325,12 @@ def encode_html(text):
         text = text.replace(k, v)
     return text
 
+def to_epoch(dt):
+    return calendar.timegm(dt.timetuple())
+    
+def from_epoch(t):
+    return datetime.datetime.utcfromtimestamp(t)
+
 def uri_b64encode(s):
     return base64.urlsafe_b64encode(s).strip('=')
 
@@ -12,6 +12,7 @@ import operator
 import hashlib
 import datetime
 import pprint
+import time
 
 # AppEngine imports
 from google.appengine.ext import db
@@ -34,6 +35,8 @@ from django.utils import simplejson
 
 # Library imports
 import yaml
+from tools.rpc_counter import RPCCounter
+from tools import datastore_cache
 
 # Local Imports
 import models
@@ -207,7 +210,23 @@ def update_card(request,box_id):
     correct = request.POST['correct'] == '1'
     box = get_by_id_or_404(request, models.Box, box_id, require_owner=True)
     studied_card = models.Card.get_by_key_name(card_id, parent=box)
-    studied_card.answered(correct)
+    box.answer_cards([(studied_card, correct)], queue=get_prefetched(request, models.StudyQueue.key_for(box)))
+    return HttpResponse('success')
+
+@login_required
+def update_cards(request, box_id):
+    """ Updates the scores of several cards at once through POST. Expects
+        matching lists of 'card_id' and 'correct' values.
+    """
+    if request.method != 'POST':
+        raise Http404
+    card_ids = request.POST.getlist('card_id')
+    corrects = [c == '1' for c in request.POST.getlist('correct')]
+    box = get_by_id_or_404(request, models.Box, box_id, require_owner=True)
+    unique_ids = list(set(card_ids))
+    cards = dict(zip(unique_ids, models.Card.get_by_key_name(unique_ids, parent=box)))
+    queue = get_prefetched(request, models.StudyQueue.key_for(box))
+    box.answer_cards([(cards[c], correct) for (c, correct) in zip(card_ids, corrects) if cards[c] is not None], queue=queue)
     return HttpResponse('success')
 
 @login_required
@@ -215,9 +234,26 @@ def next_card(request, box_id):
     """ Returns a random next card from given box.
     """
     box = get_by_id_or_404(request, models.Box, box_id, require_owner=True)
-    card = box.card_to_study()
+    card = box.card_to_study(queue=get_prefetched(request, models.StudyQueue.key_for(box)),
+                             stamp=get_prefetched(request, models.StudyQueueStamp.key_for(box)))
     return respond(request, 'card_study.html',{'box':box,'card':card})
 
+@login_required
+def next_cards(request, box_id):
+    """ Returns the next few cards from given box, the number of cards
+        is given by GET parameter 'n'.
+    """
+    MAX_CARDS = 10
+    box = get_by_id_or_404(request, models.Box, box_id, require_owner=True)
+    try:
+        n = int(request.GET.get('n', 1))
+    except ValueError:
+        n = 1
+    queue = get_prefetched(request, models.StudyQueue.key_for(box))
+    stamp = get_prefetched(request, models.StudyQueueStamp.key_for(box))
+    cards = box.cards_to_study(max(1, min(n, MAX_CARDS)), queue=queue, stamp=stamp)
+    return respond(request, 'card_study_batch.html',{'box':box,'cards':cards})
+
     
 @login_required
 def card_view(request, box_id, card_id):
@@ -241,17 +277,59 @@ def mobile_front(request):
     
 def mobile_study(request, box_id):
     box = get_by_id_or_404(request, models.Box, box_id, require_owner=True)
+    queue = get_prefetched(request, models.StudyQueue.key_for(box))
     if request.method == 'POST':
         card_id = request.POST['card_id']
         correct = request.POST['correct'] == '1'
         logging.info(correct)
         studied_card = models.Card.get_by_key_name(card_id, parent=box)
-        studied_card.answered(correct)
-    card = box.card_to_study()
+        box.answer_cards([(studied_card, correct)], queue=queue)
+    card = box.card_to_study(queue=queue, stamp=get_prefetched(request, models.StudyQueueStamp.key_for(box)))
     logging.info(card.get_cardset())
     return respond(request, 'mobile_study.html',{'box':box,'card':card})
     
 
+@admin_required
+def study_benchmark(request, box_id):
+    """ Picks and renders cards from a box like next_card does, and reports
+        the datastore RPCs and time per card. Note that it marks the cards
+        as studied.
+    """
+    N = 10
+    box = get_by_id_or_404(request, models.Box, box_id, require_owner=False)
+    lines = []
+    for i in range(N):
+        start = time.time()
+        with RPCCounter() as counter:
+            card = box.card_to_study()
+            card.render()
+        lines.append("%s: %d datastore RPCs, %.1f ms"%(card.key().name(),
+            counter.count('datastore_v3'), (time.time() - start) * 1000))
+    return HttpResponse('\n'.join(lines), mimetype='text/plain')
+    
+@admin_required
+def cache_stats(request):
+    """ Shows the hit/miss counters of the datastore cache in this instance. """
+    stats = datastore_cache.DatastoreCachingShim.GetStats()
+    if stats is None:
+        return HttpResponse('Datastore cache is not installed.', mimetype='text/plain')
+    lookups = stats['hits_request'] + stats['hits_shared'] + stats['hits_memcache'] + stats['misses']
+    hit_rate = (100.0 * (lookups - stats['misses']) / lookups) if lookups else 0.0
+    lines = ['hit rate: %.1f%% of %d lookups'%(hit_rate, lookups)]
+    lines += ['%s: %d'%(k, v) for (k, v) in sorted(stats.items()) if k != 'calls']
+    for call, (count, seconds) in sorted(stats['calls'].items()):
+        lines.append('%s: %d calls, %.1f ms average'%(call, count, 1000.0 * seconds / count))
+    return HttpResponse('\n'.join(lines), mimetype='text/plain')
+    
+def cron_reconcile_box_counters(request):
+    """ Recounts the card counters of every box, to repair drift from
+        concurrent writes. Run by cron, app.yaml restricts /cron/ to admins.
+    """
+    from google.appengine.ext import deferred
+    from engine import reconcile_all_box_counters
+    deferred.defer(reconcile_all_box_counters, _queue='boxstats')
+    return HttpResponse('Reconciling box counters.', mimetype='text/plain')
+    
 def maintenance(request):
     return HttpResponse("Doing some maintenance, we'll be back really soon.")
 
@@ -297,12 +375,27 @@ def respond(request, template, params=None):
     return render_to_response(template, params)
 
 
+def get_prefetched(request, key):
+    """ Returns the entity with the given key if the middleware started
+        fetching it, otherwise None.
+    """
+    rpc = getattr(request, 'prefetch_rpc', None)
+    if rpc is None:
+        return None
+    for entity in rpc.get_result():
+        if entity is not None and entity.key() == key:
+            return entity
+    return None
+    
+
 def get_by_id_or_404(request, kind, entity_id, require_owner=True):
     """ Gets an entity by id. If the id is not found, will error,
         unless new_if_id_none, in that case a new entity is returned.
     """
     entity_id = int(entity_id) if isinstance(entity_id, basestring) else entity_id
-    entity = kind.get_by_id(entity_id)
+    entity = get_prefetched(request, db.Key.from_path(kind.kind(), entity_id))
+    if entity is None:
+        entity = kind.get_by_id(entity_id)
     account = models.Account.current_user_account
     if entity is None:
         raise Http404
@@ -358,6 +358,11 @@ var StudyClient = new Class({
     Implements: [Options],
     options:{
         stacksize: 5,
+        answerBatch: 3,
+        // Milliseconds before a failed request is retried, doubled on
+        // each failure up to maxRetryDelay.
+        retryDelay: 2000,
+        maxRetryDelay: 60000
     },
     
     initialize: function(id, box_id, options){
@@ -365,6 +370,13 @@ var StudyClient = new Class({
         this.element   = $(id);
         this.box_id    = box_id
         this.cardstack = [];
+        this.answers   = [];
+        // Answers of the update_cards request in flight
+        this.sending   = [];
+        // Set when next_cards returned no cards, until answers are sent
+        this.outOfCards = false;
+        this.retryTimer = null;
+        this.retryDelay = this.options.retryDelay;
         this.flipKeyboard  = new Keyboard({
             defaultEventType: 'keydown',
             events: {
@@ -395,14 +407,44 @@ var StudyClient = new Class({
         }.bind(this));
         this.currentCard = null;
         this.cardRequest = new Request.HTML({
-            url:'/box/'+this.box_id+'/next_card',
+            url:'/box/'+this.box_id+'/next_cards',
             method:'get',
             noCache:true
         });
+        // Both requests change the box's study queue, so only one of them
+        // is sent at a time, each starting the other when it succeeds.
         this.cardRequest.addEvent('success',function(t,e,h,js){
-            this.cardstack.push(t);
+            // Each top level element is one card
+            var n = 0;
+            Array.each(t, function(node){
+                if (node.nodeType == 1){
+                    this.cardstack.unshift(node);
+                    n++;
+                }
+            }, this);
+            this.outOfCards = (n == 0);
+            this.retryDelay = this.options.retryDelay;
             this.update();
         }.bind(this));
+        this.cardRequest.addEvent('failure', this.retryLater.bind(this));
+        this.answerRequest = new Request({
+            url:'/box/'+this.box_id+'/update_cards',
+            method:'post',
+            link:'chain'
+        });
+        this.answerRequest.addEvent('success',function(){
+            this.sending = [];
+            this.outOfCards = false;
+            this.retryDelay = this.options.retryDelay;
+            this.update();
+        }.bind(this));
+        this.answerRequest.addEvent('failure',function(){
+            // Put the answers back, to be sent again with the next batch.
+            this.answers = this.sending.concat(this.answers);
+            this.sending = [];
+            this.retryLater();
+        }.bind(this));
+        window.addEvent('beforeunload', this.sendAnswers.pass(true,this));
         document.body.set('tween', {duration: '30000', property: 'background-color'});
         this.update();
     },
@@ -411,8 +453,49 @@ var StudyClient = new Class({
         if (this.currentCard === null){
             this.popCardStack();
         }
-        if (this.cardstack.length < this.options.stacksize){
-            this.cardRequest.send();
+        if (this.cardRequest.isRunning() || this.answerRequest.isRunning() ||
+            this.retryTimer !== null){
+            return;
+        }
+        if (this.answers.length >= this.options.answerBatch){
+            this.sendAnswers();
+        } else if (this.cardstack.length < this.options.stacksize &&
+                   (this.answers.length > 0 || !this.outOfCards)){
+            // Send the answers first, so their cards are not picked again.
+            if (this.answers.length > 0){
+                this.sendAnswers();
+            } else {
+                this.cardRequest.send({data:{n:this.options.stacksize - this.cardstack.length}});
+            }
+        }
+    },
+    
+    retryLater: function(){
+        this.retryTimer = (function(){
+            this.retryTimer = null;
+            this.update();
+        }).delay(this.retryDelay, this);
+        this.retryDelay = Math.min(this.retryDelay * 2, this.options.maxRetryDelay);
+    },
+    
+    sendAnswers: function(sync){
+        if (this.answers.length == 0){return;}
+        var data = this.answers.map(function(a){
+            return 'card_id=' + encodeURIComponent(a.card_id) + '&correct=' + (a.correct ? '1' : '0');
+        }).join('&');
+        if (sync){
+            // When leaving the page, an asynchronous request could be aborted.
+            new Request({
+                url:'/box/'+this.box_id+'/update_cards',
+                method:'post',
+                async:false
+            }).send({data:data});
+            this.answers = [];
+        } else {
+            // Kept until the request succeeds, see the failure event.
+            this.sending = this.answers;
+            this.answers = [];
+            this.answerRequest.send({data:data});
         }
     },
     
@@ -448,8 +531,10 @@ var StudyClient = new Class({
     
     sendCard: function(correct){
         if (this.currentCard === null){return;}
-        this.cardContainer.getElement('form .correct').set('value', correct?'1':'0')
-        this.cardContainer.getElement('form').send()
+        this.answers.push({
+            card_id: this.cardContainer.getElement('form .card_id').get('value'),
+            correct: correct
+        });
         if(correct){
             this.element.getElement('.button.correct').highlight('#AEE36D')
         } else {
@@ -6,13 +6,19 @@ datastore_cache.py
 Created by Alkis Evlogimenos on 2009-04-19.
 """
 
+import hashlib
 import itertools
 import logging
 import threading
+import time
+import zlib
 
 from google.appengine.api import memcache
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+
+from tools.lru import LRUCache
 
 """Provides a shim that caches datastore Get calls.
 
@@ -20,6 +26,10 @@ Example code:
 
 import datastore_cache
 datastore_cache.DatastoreCachingShim.Install()
+# Optionally also cache the results of queries on some kinds:
+datastore_cache.DatastoreCachingShim.CacheQueries('Account', 'Box')
+# Keep kinds that are written often out of the cache shared between requests:
+datastore_cache.DatastoreCachingShim.DontShare('Box', 'StudyQueue')
 # ...
 def main(args):
   util.run_wsgi_app(application)
@@ -87,16 +97,282 @@ class APIProxyShim(object):
       cls._instance = None
 
 class DatastoreCachingShim(APIProxyShim):
+  """Caches entities in two tiers in front of the datastore: in process
+  (per request, and shared between requests up to a maximum age) and in
+  memcache.
+  """
   SERVICE_NAME = 'datastore_v3'
+  # Number of entities in the cache shared by the requests in this process.
+  SHARED_CACHE_SIZE = 1000
+  # Seconds an entry in the shared cache is used; other instances can
+  # write the entity in the meantime without invalidating it here.
+  SHARED_CACHE_MAX_AGE = 10
+  # Kinds that are not kept in the shared cache, see DontShare().
+  UNSHARED_KINDS = frozenset()
+  # Seconds that a key is remembered as not found.
+  NEGATIVE_TTL = 60
+  # Cached in place of entities that were not found.
+  NOT_FOUND = '__not_found__'
+  # Entities are stored in memcache as encoded protocol buffers, compressed
+  # above COMPRESS_THRESHOLD bytes. Entities larger than MAX_CACHED_SIZE
+  # after compression are not stored in memcache.
+  COMPRESS_THRESHOLD = 1024
+  MAX_CACHED_SIZE = 500000
+  # Prefix for memcache keys, changed along with the stored format.
+  KEY_PREFIX = 'dsc1:'
+  # Kinds whose query results are cached, see CacheQueries().
+  CACHED_QUERY_KINDS = frozenset()
+  # Seconds a query result is kept in memcache.
+  QUERY_CACHE_TTL = 600
+  # Seconds the result of a query without an ancestor is kept. Such queries
+  # are eventually consistent, so a result can miss a write that bumped its
+  # generation; it must expire soon, as nothing else invalidates it.
+  GLOBAL_QUERY_CACHE_TTL = 5
 
   def __init__(self, default_stub):
     super(DatastoreCachingShim, self).__init__(default_stub)
     self.local = threading.local()
     self.local.to_delete = dict()
+    self.shared = LRUCache(self.SHARED_CACHE_SIZE)
+    self.ResetStats()
+
+  def ResetStats(self):
+    """Resets the hit/miss counters and call timings of this process."""
+    self.stats = {'hits_request': 0,
+                  'hits_shared': 0,
+                  'hits_memcache': 0,
+                  'hits_negative': 0,
+                  'misses': 0,
+                  'bytes_cached': 0,
+                  'skipped_oversized': 0,
+                  'hits_query': 0,
+                  'misses_query': 0,
+                  'calls': dict()}
+
+  @classmethod
+  def GetStats(cls):
+    """Returns the counters of the installed shim, or None. Calls maps
+    each call type to its count and total seconds."""
+    if cls._instance:
+      return cls._instance.stats
+    return None
+
+  def MakeSyncCall(self, service, call, request, response):
+    start = time.time()
+    try:
+      super(DatastoreCachingShim, self).MakeSyncCall(service, call, request, response)
+    finally:
+      count, seconds = self.stats['calls'].get(call, (0, 0.0))
+      self.stats['calls'][call] = (count + 1, seconds + time.time() - start)
+
+  @classmethod
+  def CacheQueries(cls, *kinds):
+    """Enables caching the results of queries on the given kinds.
+
+    Results are cached in memcache under a generation number, of the
+    entity group for ancestor queries and of the kind for other queries.
+    Writes through the shim to an entity of one of these kinds increment
+    both its group's and its kind's generation, so only queries that can
+    see the written entity are invalidated.
+
+    Only ancestor queries are strongly consistent. A query without an
+    ancestor that runs just after a write may not see it yet, and would be
+    cached that way under the new generation, so its results are only kept
+    for GLOBAL_QUERY_CACHE_TTL seconds.
+    """
+    cls.CACHED_QUERY_KINDS = cls.CACHED_QUERY_KINDS.union(kinds)
+
+  @classmethod
+  def DontShare(cls, *kinds):
+    """Keeps entities of the given kinds out of the cache shared between
+    requests, so that a write by another instance is seen right away.
+    They are still cached per request and in memcache.
+    """
+    cls.UNSHARED_KINDS = cls.UNSHARED_KINDS.union(kinds)
+
+  @classmethod
+  def ResetCache(cls):
+    """Clears the per-request cache. Call this at the end of each request."""
+    if cls._instance:
+      cls._instance.local.entities = dict()
+
+  def _RequestCache(self):
+    if not hasattr(self.local, 'entities'):
+      self.local.entities = dict()
+    return self.local.entities
+
+  def _GetLocal(self, encoded_keys):
+    """Returns the entities found in the in-process tiers."""
+    request_cache = self._RequestCache()
+    found = dict()
+    now = time.time()
+    for encoded_key in encoded_keys:
+      entity = request_cache.get(encoded_key)
+      if entity is not None:
+        self.stats['hits_request'] += 1
+      else:
+        cached = self.shared.get(encoded_key)
+        if cached is not None and now < cached[0]:
+          entity = cached[1]
+          request_cache[encoded_key] = entity
+          self.stats['hits_shared'] += 1
+      if entity is not None:
+        found[encoded_key] = entity
+    return found
+
+  def _IsShared(self, encoded_key):
+    if not self.UNSHARED_KINDS:
+      return True
+    path = entity_pb.Reference(encoded_key).path()
+    return path.element(path.element_size() - 1).type() not in self.UNSHARED_KINDS
+
+  def _SetLocal(self, entities):
+    request_cache = self._RequestCache()
+    now = time.time()
+    for encoded_key, entity in entities.iteritems():
+      request_cache[encoded_key] = entity
+      if not self._IsShared(encoded_key):
+        continue
+      max_age = self.SHARED_CACHE_MAX_AGE
+      if self._IsNotFound(entity):
+        max_age = min(max_age, self.NEGATIVE_TTL)
+      self.shared.set(encoded_key, (now + max_age, entity))
+
+  def _IsNotFound(self, entity):
+    return isinstance(entity, basestring) and entity == self.NOT_FOUND
+
+  def _Encode(self, entity):
+    """Returns the memcache value for an entity, or None if it is too large.
+    The first character tells the format: N(ot found), P(lain) or Z(lib)."""
+    if self._IsNotFound(entity):
+      return 'N'
+    data = entity.Encode()
+    if len(data) > self.COMPRESS_THRESHOLD:
+      data = 'Z' + zlib.compress(data)
+    else:
+      data = 'P' + data
+    if len(data) > self.MAX_CACHED_SIZE:
+      return None
+    return data
+
+  def _Decode(self, data):
+    if data[0] == 'N':
+      return self.NOT_FOUND
+    if data[0] == 'Z':
+      return entity_pb.EntityProto(zlib.decompress(data[1:]))
+    return entity_pb.EntityProto(data[1:])
+
+  def _GetMemcache(self, encoded_keys):
+    cached = memcache.get_multi(encoded_keys, key_prefix=self.KEY_PREFIX)
+    return dict((k, self._Decode(v)) for (k, v) in cached.iteritems())
+
+  def _SetMemcache(self, entities):
+    """Stores found entities and NOT_FOUND markers in memcache."""
+    found = dict()
+    not_found = dict()
+    oversized = []
+    for encoded_key, entity in entities.iteritems():
+      data = self._Encode(entity)
+      if data is None:
+        oversized.append(encoded_key)
+      elif data == 'N':
+        not_found[encoded_key] = data
+      else:
+        found[encoded_key] = data
+    if found:
+      self.stats['bytes_cached'] += sum(len(d) for d in found.itervalues())
+      memcache.set_multi(found, key_prefix=self.KEY_PREFIX)
+    if not_found:
+      memcache.set_multi(not_found, time=self.NEGATIVE_TTL, key_prefix=self.KEY_PREFIX)
+    if oversized:
+      # Drop any older, smaller version of these entities.
+      self.stats['skipped_oversized'] += len(oversized)
+      memcache.delete_multi(oversized, key_prefix=self.KEY_PREFIX)
+
+  def _DeleteLocal(self, encoded_keys):
+    request_cache = self._RequestCache()
+    for encoded_key in encoded_keys:
+      request_cache.pop(encoded_key, None)
+      self.shared.delete(encoded_key)
+
+  def _GroupGeneration(self, key):
+    """Returns the generation name for the entity group of a key."""
+    root = key.path().element(0)
+    return 'qgen:%s:%s:%s:%s' % (key.app(), key.name_space(), root.type(),
+                                 root.name() or root.id())
+
+  def _KindGeneration(self, app, name_space, kind):
+    return 'qgen:%s:%s:%s' % (app, name_space, kind)
+
+  def _BumpGenerations(self, keys):
+    """Invalidates the cached queries that can see any of the given keys."""
+    generations = set()
+    for key in keys:
+      kind = key.path().element(key.path().element_size() - 1).type()
+      if kind in self.CACHED_QUERY_KINDS:
+        generations.add(self._GroupGeneration(key))
+        generations.add(self._KindGeneration(key.app(), key.name_space(), kind))
+    if generations:
+      memcache.offset_multi(dict.fromkeys(generations, 1),
+                            key_prefix=self.KEY_PREFIX,
+                            initial_value=int(time.time()))
+
+  def _QueryCacheKey(self, request):
+    """Returns the memcache key for the current result of a query, or None
+    if the query is not cached."""
+    if (request.has_transaction() or not request.has_kind() or
+        request.kind() not in self.CACHED_QUERY_KINDS):
+      return None
+    if request.has_ancestor():
+      generation = self._GroupGeneration(request.ancestor())
+    else:
+      generation = self._KindGeneration(request.app(), request.name_space(),
+                                        request.kind())
+    value = memcache.get(generation, key_prefix=self.KEY_PREFIX)
+    if value is None:
+      # Start a lost generation from the clock, so that results cached
+      # under its previous values are not used again.
+      value = int(time.time())
+      if not memcache.add(generation, value, key_prefix=self.KEY_PREFIX):
+        value = memcache.get(generation, key_prefix=self.KEY_PREFIX)
+        if value is None:
+          return None
+    # Normalize the query: the batch size does not change a complete
+    # result, and filters are sorted so their order does not matter.
+    query = datastore_pb.Query()
+    query.CopyFrom(request)
+    query.clear_count()
+    filters = sorted(f.Encode() for f in query.filter_list())
+    query.clear_filter()
+    for f in filters:
+      query.add_filter().CopyFrom(datastore_pb.Query_Filter(f))
+    return 'q:%s:%s' % (hashlib.sha1(query.Encode()).hexdigest(), value)
+
+  def _Dynamic_RunQuery(self, request, response):
+    """Returns the result of cached queries from memcache. Only results
+    that fit in the first batch are cached."""
+    cache_key = self._QueryCacheKey(request)
+    if cache_key is not None:
+      data = memcache.get(cache_key, key_prefix=self.KEY_PREFIX)
+      if data is not None:
+        self.stats['hits_query'] += 1
+        response.CopyFrom(datastore_pb.QueryResult(zlib.decompress(data)))
+        return
+      self.stats['misses_query'] += 1
+
+    self.CallWrappedStub('RunQuery', request, response)
+
+    if cache_key is not None and not response.more_results():
+      data = zlib.compress(response.Encode())
+      if len(data) <= self.MAX_CACHED_SIZE:
+        if request.has_ancestor():
+          ttl = self.QUERY_CACHE_TTL
+        else:
+          ttl = self.GLOBAL_QUERY_CACHE_TTL
+        memcache.set(cache_key, data, time=ttl, key_prefix=self.KEY_PREFIX)
 
   def _Dynamic_Get(self, request, response):
     """Intercepts get requests and returns them from cache if available."""
-    logging.info("Tx: %s, Keys: %s", request.has_transaction(), [str(x) for x in request.key_list()])
     if request.has_transaction():
       self.CallWrappedStub('Get', request, response)
       return
@@ -104,7 +380,13 @@ class DatastoreCachingShim(APIProxyShim):
     new_request = datastore_pb.GetRequest()
     new_response = datastore_pb.GetResponse()
     encoded_keys = [k.Encode() for k in request.key_list()]
-    cached = memcache.get_multi(encoded_keys)
+    cached = self._GetLocal(encoded_keys)
+    missing = [k for k in encoded_keys if k not in cached]
+    if missing:
+      from_memcache = self._GetMemcache(missing)
+      self.stats['hits_memcache'] += len(from_memcache)
+      self._SetLocal(from_memcache)
+      cached.update(from_memcache)
 
     for key, encoded_key in itertools.izip(request.key_list(), encoded_keys):
       if encoded_key not in cached:
@@ -117,16 +399,22 @@ class DatastoreCachingShim(APIProxyShim):
     to_put = dict()
     for encoded_key in encoded_keys:
       entity = cached.get(encoded_key, None)
-      if entity:
+      if self._IsNotFound(entity):
+        self.stats['hits_negative'] += 1
+        response.add_entity()
+      elif entity:
         response.add_entity().mutable_entity().CopyFrom(entity)
       else:
+        self.stats['misses'] += 1
         entity = entity_iter.next()
-        if entity.entity().IsInitialized():
-          # self.entity_cache[encoded_key] = entity.entity()
+        if not entity.has_entity():
+          to_put[encoded_key] = self.NOT_FOUND
+        elif entity.entity().IsInitialized():
           to_put[encoded_key] = entity.entity()
         response.add_entity().CopyFrom(entity)
     if to_put:
-      memcache.set_multi(to_put)
+      self._SetLocal(to_put)
+      self._SetMemcache(to_put)
 
   def _Dynamic_Put(self, request, response):
     """Intercepts puts and adds them to the cache."""
@@ -144,7 +432,9 @@ class DatastoreCachingShim(APIProxyShim):
       e.key().CopyFrom(k)
       to_put[k.Encode()] = e
     if to_put:
-      memcache.set_multi(to_put)
+      self._SetLocal(to_put)
+      self._SetMemcache(to_put)
+    self._BumpGenerations(response.key_list())
 
   def _Dynamic_Delete(self, request, response):
     """Intercepts deletes and deletes entries from the cache."""
@@ -158,7 +448,9 @@ class DatastoreCachingShim(APIProxyShim):
       self.local.to_delete[request.transaction().handle()].extend(to_delete)
       return
 
-    memcache.delete_multi(to_delete)
+    self._DeleteLocal(to_delete)
+    memcache.delete_multi(to_delete, key_prefix=self.KEY_PREFIX)
+    self._BumpGenerations(request.key_list())
 
   def _Dynamic_Next(self, request, response):
     """Intercepts query results and caches the returned entities."""
@@ -166,7 +458,8 @@ class DatastoreCachingShim(APIProxyShim):
 
     if not response.keys_only():
       to_put = dict([(e.key().Encode(), e) for e in response.result_list()])
-      memcache.set_multi(to_put)
+      self._SetLocal(to_put)
+      self._SetMemcache(to_put)
 
   def _Dynamic_BeginTransaction(self, request, transaction):
     """Intercepts the beginning of transactions and creates thread local storage for deletions"""
@@ -178,10 +471,14 @@ class DatastoreCachingShim(APIProxyShim):
     # We delete from cache before we commit otherwise we have a race condition.
     to_delete = self.local.to_delete[transaction.handle()]
     if to_delete:
-      memcache.delete_multi(to_delete)
+      self._DeleteLocal(to_delete)
+      memcache.delete_multi(to_delete, key_prefix=self.KEY_PREFIX)
     del self.local.to_delete[transaction.handle()]
 
     self.CallWrappedStub('Commit', transaction, transaction_response)
+    # Queries are invalidated after the commit, so that none are cached
+    # with the state from before it under the new generation.
+    self._BumpGenerations(entity_pb.Reference(k) for k in to_delete)
 
   def _Dynamic_Rollback(self, transaction, transaction_response):
     """Intercepts the rollback of transactions and clears the thread local storage for them"""
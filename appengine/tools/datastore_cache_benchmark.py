@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Compares the memcache formats of DatastoreCachingShim: pickled
+EntityProto objects (the old format, as memcache pickles them) against
+encoded protocol buffers, zlib compressed above a size threshold.
+
+Needs the App Engine SDK on the path. Run from the appengine directory:
+
+  python -m tools.datastore_cache_benchmark
+"""
+
+import cPickle
+import os
+import random
+import time
+
+os.environ.setdefault('APPLICATION_ID', 'cardbox-benchmark')
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+
+from tools.datastore_cache import DatastoreCachingShim
+
+WORDS = ['aardvark', 'boek', 'cheval', 'dog', 'eend', 'fiets', 'gato',
+         'huis', 'inu', 'jardin', 'kat', 'libro', 'maison', 'neko']
+
+
+def factsheet_entity(n_rows):
+  """A Factsheet-like entity with a YAML list of n_rows rows as content."""
+  rows = ['- [%s%d, %s, %s]' % (random.choice(WORDS), i,
+                                 random.choice(WORDS), random.choice(WORDS))
+          for i in xrange(n_rows)]
+  content = 'columns: [word, translation, example]\nrows:\n' + '\n'.join(rows)
+  entity = datastore.Entity('Factsheet', name='list_%d' % n_rows)
+  entity['content'] = datastore_types.Text(content)
+  entity['name'] = 'list_%d' % n_rows
+  entity['revision_number'] = 1
+  return entity.ToPb()
+
+
+def timed(func, repeat):
+  start = time.time()
+  for _ in xrange(repeat):
+    result = func()
+  return result, (time.time() - start) / repeat
+
+
+def main(repeat=20):
+  shim = DatastoreCachingShim.__new__(DatastoreCachingShim)
+  shim.stats = {'skipped_oversized': 0}
+  print '%8s  %10s %10s %10s  %10s %10s %10s' % (
+      'rows', 'pickle B', 'enc ms', 'dec ms', 'new B', 'enc ms', 'dec ms')
+  for n_rows in (10, 100, 1000, 5000, 20000):
+    entity = factsheet_entity(n_rows)
+    pickled, pickle_enc = timed(
+        lambda: cPickle.dumps(entity, cPickle.HIGHEST_PROTOCOL), repeat)
+    _, pickle_dec = timed(lambda: cPickle.loads(pickled), repeat)
+    encoded, new_enc = timed(lambda: shim._Encode(entity), repeat)
+    if encoded is None:
+      new_size, new_dec = 'too large', 0.0
+    else:
+      new_size = len(encoded)
+      _, new_dec = timed(lambda: shim._Decode(encoded), repeat)
+    print '%8d  %10d %10.2f %10.2f  %10s %10.2f %10.2f' % (
+        n_rows, len(pickled), pickle_enc * 1000, pickle_dec * 1000,
+        new_size, new_enc * 1000, new_dec * 1000)
+
+
+if __name__ == '__main__':
+  main()
@@ -27,6 +27,7 @@ Applies the patch onto another text, allowing for errors.
 __author__ = 'fraser@google.com (Neil Fraser)'
 
 import math
+import sys
 import time
 import urllib
 import re
@@ -46,9 +47,9 @@ class diff_match_patch:
     self.Diff_Timeout = 1.0
     # Cost of an empty edit operation in terms of edit characters.
     self.Diff_EditCost = 4
-    # The size beyond which the double-ended diff activates.
-    # Double-ending is twice as fast, but less accurate.
-    self.Diff_DualThreshold = 32
+    # Combined length of two texts beyond which diff_main first diffs them
+    # line by line, even if checklines is false (0 to never force this).
+    self.Diff_LineModeThreshold = 100000
     # At what point is no match declared (0.0 = perfection, 1.0 = very loose).
     self.Match_Threshold = 0.5
     # How far to search for a match (0 = exact location, 1000+ = broad match).
@@ -65,8 +66,9 @@ class diff_match_patch:
 
     # How many bits in a number?
     # Python has no maximum, thus to disable patch splitting set to 0.
+    # Patches then match with their full context in one pass of match_bitap,
+    # which uses Python's arbitrary width integers as its bit arrays.
     # However to avoid long patches in certain pathological cases, use 32.
-    # Multiple short patches (using native ints) are much faster than long ones.
     self.Match_MaxBits = 32
 
   #  DIFF FUNCTIONS
@@ -78,7 +80,7 @@ class diff_match_patch:
   DIFF_INSERT = 1
   DIFF_EQUAL = 0
 
-  def diff_main(self, text1, text2, checklines=True):
+  def diff_main(self, text1, text2, checklines=True, deadline=None):
     """Find the differences between two texts.  Simplifies the problem by
       stripping any common prefix or suffix off the texts before diffing.
 
@@ -88,14 +90,29 @@ class diff_match_patch:
       checklines: Optional speedup flag.  If present and false, then don't run
         a line-level diff first to identify the changed areas.
         Defaults to true, which does a faster, slightly less optimal diff.
+        Texts longer than Diff_LineModeThreshold together are always diffed
+        line by line first.
+      deadline: Optional time when the diff should be complete by.  Used
+        internally for recursive calls.  Users should set Diff_Timeout instead.
 
     Returns:
       Array of changes.
     """
+    # Set a deadline by which time the diff must be complete.
+    if deadline is None:
+      if self.Diff_Timeout <= 0:
+        deadline = sys.maxint
+      else:
+        deadline = time.time() + self.Diff_Timeout
+      if (self.Diff_LineModeThreshold > 0 and
+          len(text1) + len(text2) > self.Diff_LineModeThreshold):
+        checklines = True
 
     # Check for equality (speedup)
     if text1 == text2:
-      return [(self.DIFF_EQUAL, text1)]
+      if text1:
+        return [(self.DIFF_EQUAL, text1)]
+      return []
 
     # Trim off common prefix (speedup)
     commonlength = self.diff_commonPrefix(text1, text2)
@@ -113,7 +130,7 @@ class diff_match_patch:
       text2 = text2[:-commonlength]
 
     # Compute the diff on the middle block
-    diffs = self.diff_compute(text1, text2, checklines)
+    diffs = self.diff_compute(text1, text2, checklines, deadline)
 
     # Restore the prefix and suffix
     if commonprefix:
@@ -123,7 +140,7 @@ class diff_match_patch:
     self.diff_cleanupMerge(diffs)
     return diffs
 
-  def diff_compute(self, text1, text2, checklines):
+  def diff_compute(self, text1, text2, checklines, deadline):
     """Find the differences between two texts.  Assumes that the texts do not
       have any common prefix or suffix.
 
@@ -133,6 +150,7 @@ class diff_match_patch:
       checklines: Speedup flag.  If false, then don't run a line-level diff
         first to identify the changed areas.
         If true, then run a faster, slightly less optimal diff.
+      deadline: Time when the diff should be complete by.
 
     Returns:
       Array of changes.
@@ -159,6 +177,11 @@ class diff_match_patch:
         diffs[0] = (self.DIFF_DELETE, diffs[0][1])
         diffs[2] = (self.DIFF_DELETE, diffs[2][1])
       return diffs
+
+    if len(shorttext) == 1:
+      # Single character string.
+      # After the previous speedup, the character can't be an equality.
+      return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
     longtext = shorttext = None  # Garbage collect.
 
     # Check to see if the problem can be split in two.
@@ -167,59 +190,202 @@ class diff_match_patch:
       # A half-match was found, sort out the return data.
       (text1_a, text1_b, text2_a, text2_b, mid_common) = hm
       # Send both pairs off for separate processing.
-      diffs_a = self.diff_main(text1_a, text2_a, checklines)
-      diffs_b = self.diff_main(text1_b, text2_b, checklines)
+      diffs_a = self.diff_main(text1_a, text2_a, checklines, deadline)
+      diffs_b = self.diff_main(text1_b, text2_b, checklines, deadline)
       # Merge the results.
       return diffs_a + [(self.DIFF_EQUAL, mid_common)] + diffs_b
 
-    # Perform a real diff.
-    if checklines and (len(text1) < 100 or len(text2) < 100):
-      checklines = False  # Too trivial for the overhead.
-    if checklines:
-      # Scan the text on a line-by-line basis first.
-      (text1, text2, linearray) = self.diff_linesToChars(text1, text2)
-
-    diffs = self.diff_map(text1, text2)
-    if not diffs:  # No acceptable result.
-      diffs = [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
-    if checklines:
-      # Convert the diff back to original text.
-      self.diff_charsToLines(diffs, linearray)
-      # Eliminate freak matches (e.g. blank lines)
-      self.diff_cleanupSemantic(diffs)
-
-      # Rediff any replacement blocks, this time character-by-character.
-      # Add a dummy entry at the end.
-      diffs.append((self.DIFF_EQUAL, ''))
-      pointer = 0
-      count_delete = 0
-      count_insert = 0
-      text_delete = ''
-      text_insert = ''
-      while pointer < len(diffs):
-        if diffs[pointer][0] == self.DIFF_INSERT:
-          count_insert += 1
-          text_insert += diffs[pointer][1]
-        elif diffs[pointer][0] == self.DIFF_DELETE:
-          count_delete += 1
-          text_delete += diffs[pointer][1]
-        elif diffs[pointer][0] == self.DIFF_EQUAL:
-          # Upon reaching an equality, check for prior redundancies.
-          if count_delete >= 1 and count_insert >= 1:
-            # Delete the offending records and add the merged ones.
-            a = self.diff_main(text_delete, text_insert, False)
-            diffs[pointer - count_delete - count_insert : pointer] = a
-            pointer = pointer - count_delete - count_insert + len(a)
-          count_insert = 0
-          count_delete = 0
-          text_delete = ''
-          text_insert = ''
+    if checklines and len(text1) > 100 and len(text2) > 100:
+      return self.diff_lineMode(text1, text2, deadline)
 
-        pointer += 1
+    return self.diff_bisect(text1, text2, deadline)
+
+  def diff_lineMode(self, text1, text2, deadline):
+    """Do a quick line-level diff on both strings, then rediff the parts for
+      greater accuracy.
+      This speedup can produce non-minimal diffs.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Time when the diff should be complete by.
+
+    Returns:
+      Array of changes.
+    """
+
+    # Scan the text on a line-by-line basis first.
+    (text1, text2, linearray) = self.diff_linesToChars(text1, text2)
+
+    diffs = self.diff_main(text1, text2, False, deadline)
+
+    # Convert the diff back to original text.
+    self.diff_charsToLines(diffs, linearray)
+    # Eliminate freak matches (e.g. blank lines)
+    self.diff_cleanupSemantic(diffs)
+
+    # Rediff any replacement blocks, this time character-by-character.
+    # Add a dummy entry at the end.
+    diffs.append((self.DIFF_EQUAL, ''))
+    pointer = 0
+    count_delete = 0
+    count_insert = 0
+    text_delete = ''
+    text_insert = ''
+    while pointer < len(diffs):
+      if diffs[pointer][0] == self.DIFF_INSERT:
+        count_insert += 1
+        text_insert += diffs[pointer][1]
+      elif diffs[pointer][0] == self.DIFF_DELETE:
+        count_delete += 1
+        text_delete += diffs[pointer][1]
+      elif diffs[pointer][0] == self.DIFF_EQUAL:
+        # Upon reaching an equality, check for prior redundancies.
+        if count_delete >= 1 and count_insert >= 1:
+          # Delete the offending records and add the merged ones.
+          a = self.diff_main(text_delete, text_insert, False, deadline)
+          diffs[pointer - count_delete - count_insert : pointer] = a
+          pointer = pointer - count_delete - count_insert + len(a)
+        count_insert = 0
+        count_delete = 0
+        text_delete = ''
+        text_insert = ''
+
+      pointer += 1
+
+    diffs.pop()  # Remove the dummy entry at the end.
 
-      diffs.pop()  # Remove the dummy entry at the end.
     return diffs
 
+  def diff_bisect(self, text1, text2, deadline):
+    """Find the 'middle snake' of a diff, split the problem in two
+      and return the recursively constructed diff.
+      See Myers 1986 paper: An O(ND) Difference Algorithm and Its Variations.
+      Only two arrays of the furthest reaching paths are kept, so memory
+      use is linear in the length of the texts.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Time at which to bail if not yet complete.
+
+    Returns:
+      Array of diff tuples.
+    """
+
+    # Cache the text lengths to prevent multiple calls.
+    text1_length = len(text1)
+    text2_length = len(text2)
+    max_d = (text1_length + text2_length + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = v1[:]
+    delta = text1_length - text2_length
+    # If the total number of characters is odd, then the front path will
+    # collide with the reverse path.
+    front = (delta % 2 != 0)
+    # Offsets for start and end of k loop.
+    # Prevents mapping of space beyond the grid.
+    k1start = 0
+    k1end = 0
+    k2start = 0
+    k2end = 0
+    for d in xrange(max_d):
+      # Bail out if deadline is reached.
+      if time.time() > deadline:
+        break
+
+      # Walk the front path one step.
+      for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+        k1_offset = v_offset + k1
+        if k1 == -d or (k1 != d and
+            v1[k1_offset - 1] < v1[k1_offset + 1]):
+          x1 = v1[k1_offset + 1]
+        else:
+          x1 = v1[k1_offset - 1] + 1
+        y1 = x1 - k1
+        while (x1 < text1_length and y1 < text2_length and
+               text1[x1] == text2[y1]):
+          x1 += 1
+          y1 += 1
+        v1[k1_offset] = x1
+        if x1 > text1_length:
+          # Ran off the right of the graph.
+          k1end += 2
+        elif y1 > text2_length:
+          # Ran off the bottom of the graph.
+          k1start += 2
+        elif front:
+          k2_offset = v_offset + delta - k1
+          if k2_offset >= 0 and k2_offset < v_length and v2[k2_offset] != -1:
+            # Mirror x2 onto top-left coordinate system.
+            x2 = text1_length - v2[k2_offset]
+            if x1 >= x2:
+              # Overlap detected.
+              return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+
+      # Walk the reverse path one step.
+      for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+        k2_offset = v_offset + k2
+        if k2 == -d or (k2 != d and
+            v2[k2_offset - 1] < v2[k2_offset + 1]):
+          x2 = v2[k2_offset + 1]
+        else:
+          x2 = v2[k2_offset - 1] + 1
+        y2 = x2 - k2
+        while (x2 < text1_length and y2 < text2_length and
+               text1[-x2 - 1] == text2[-y2 - 1]):
+          x2 += 1
+          y2 += 1
+        v2[k2_offset] = x2
+        if x2 > text1_length:
+          # Ran off the left of the graph.
+          k2end += 2
+        elif y2 > text2_length:
+          # Ran off the top of the graph.
+          k2start += 2
+        elif not front:
+          k1_offset = v_offset + delta - k2
+          if k1_offset >= 0 and k1_offset < v_length and v1[k1_offset] != -1:
+            x1 = v1[k1_offset]
+            y1 = v_offset + x1 - k1_offset
+            # Mirror x2 onto top-left coordinate system.
+            x2 = text1_length - x2
+            if x1 >= x2:
+              # Overlap detected.
+              return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
+
+    # Diff took too long and hit the deadline or
+    # number of diffs equals number of characters, no commonality at all.
+    return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+  def diff_bisectSplit(self, text1, text2, x, y, deadline):
+    """Given the location of the 'middle snake', split the diff in two parts
+    and recurse.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      x: Index of split point in text1.
+      y: Index of split point in text2.
+      deadline: Time at which to bail if not yet complete.
+
+    Returns:
+      Array of diff tuples.
+    """
+    text1a = text1[:x]
+    text2a = text2[:y]
+    text1b = text1[x:]
+    text2b = text2[y:]
+
+    # Compute both diffs serially.
+    diffs = self.diff_main(text1a, text2a, False, deadline)
+    diffsb = self.diff_main(text1b, text2b, False, deadline)
+
+    return diffs + diffsb
+
   def diff_linesToChars(self, text1, text2):
     """Split two texts into an array of strings.  Reduce the texts to a string
     of hashes where each Unicode character represents one line.
@@ -290,206 +456,6 @@ class diff_match_patch:
         text.append(lineArray[ord(char)])
       diffs[x] = (diffs[x][0], "".join(text))
 
-  def diff_map(self, text1, text2):
-    """Explore the intersection points between the two texts.
-
-    Args:
-      text1: Old string to be diffed.
-      text2: New string to be diffed.
-
-    Returns:
-      Array of diff tuples or None if no diff available.
-    """
-
-    # Unlike in most languages, Python counts time in seconds.
-    s_end = time.time() + self.Diff_Timeout  # Don't run for too long.
-    # Cache the text lengths to prevent multiple calls.
-    text1_length = len(text1)
-    text2_length = len(text2)
-    max_d = text1_length + text2_length - 1
-    doubleEnd = self.Diff_DualThreshold * 2 < max_d
-    v_map1 = []
-    v_map2 = []
-    v1 = {}
-    v2 = {}
-    v1[1] = 0
-    v2[1] = 0
-    footsteps = {}
-    done = False
-    # If the total number of characters is odd, then the front path will
-    # collide with the reverse path.
-    front = (text1_length + text2_length) % 2
-    for d in xrange(max_d):
-      # Bail out if timeout reached.
-      if self.Diff_Timeout > 0 and time.time() > s_end:
-        return None
-
-      # Walk the front path one step.
-      v_map1.append({})
-      for k in xrange(-d, d + 1, 2):
-        if k == -d or k != d and v1[k - 1] < v1[k + 1]:
-          x = v1[k + 1]
-        else:
-          x = v1[k - 1] + 1
-        y = x - k
-        if doubleEnd:
-          footstep = (x, y)
-          if front and footstep in footsteps:
-            done = True
-          if not front:
-            footsteps[footstep] = d
-
-        while (not done and x < text1_length and y < text2_length and
-               text1[x] == text2[y]):
-          x += 1
-          y += 1
-          if doubleEnd:
-            footstep = (x, y)
-            if front and footstep in footsteps:
-              done = True
-            if not front:
-              footsteps[footstep] = d
-
-        v1[k] = x
-        v_map1[d][(x, y)] = True
-        if x == text1_length and y == text2_length:
-          # Reached the end in single-path mode.
-          return self.diff_path1(v_map1, text1, text2)
-        elif done:
-          # Front path ran over reverse path.
-          v_map2 = v_map2[:footsteps[footstep] + 1]
-          a = self.diff_path1(v_map1, text1[:x], text2[:y])
-          b = self.diff_path2(v_map2, text1[x:], text2[y:])
-          return a + b
-
-      if doubleEnd:
-        # Walk the reverse path one step.
-        v_map2.append({})
-        for k in xrange(-d, d + 1, 2):
-          if k == -d or k != d and v2[k - 1] < v2[k + 1]:
-            x = v2[k + 1]
-          else:
-            x = v2[k - 1] + 1
-          y = x - k
-          footstep = (text1_length - x, text2_length - y)
-          if not front and footstep in footsteps:
-            done = True
-          if front:
-            footsteps[footstep] = d
-          while (not done and x < text1_length and y < text2_length and
-                 text1[-x - 1] == text2[-y - 1]):
-            x += 1
-            y += 1
-            footstep = (text1_length - x, text2_length - y)
-            if not front and footstep in footsteps:
-              done = True
-            if front:
-              footsteps[footstep] = d
-
-          v2[k] = x
-          v_map2[d][(x, y)] = True
-          if done:
-            # Reverse path ran over front path.
-            v_map1 = v_map1[:footsteps[footstep] + 1]
-            a = self.diff_path1(v_map1, text1[:text1_length - x],
-                                text2[:text2_length - y])
-            b = self.diff_path2(v_map2, text1[text1_length - x:],
-                                text2[text2_length - y:])
-            return a + b
-
-    # Number of diffs equals number of characters, no commonality at all.
-    return None
-
-  def diff_path1(self, v_map, text1, text2):
-    """Work from the middle back to the start to determine the path.
-
-    Args:
-      v_map: Array of paths.
-      text1: Old string fragment to be diffed.
-      text2: New string fragment to be diffed.
-
-    Returns:
-      Array of diff tuples.
-    """
-    path = []
-    x = len(text1)
-    y = len(text2)
-    last_op = None
-    for d in xrange(len(v_map) - 2, -1, -1):
-      while True:
-        if (x - 1, y) in v_map[d]:
-          x -= 1
-          if last_op == self.DIFF_DELETE:
-            path[0] = (self.DIFF_DELETE, text1[x] + path[0][1])
-          else:
-            path[:0] = [(self.DIFF_DELETE, text1[x])]
-          last_op = self.DIFF_DELETE
-          break
-        elif (x, y - 1) in v_map[d]:
-          y -= 1
-          if last_op == self.DIFF_INSERT:
-            path[0] = (self.DIFF_INSERT, text2[y] + path[0][1])
-          else:
-            path[:0] = [(self.DIFF_INSERT, text2[y])]
-          last_op = self.DIFF_INSERT
-          break
-        else:
-          x -= 1
-          y -= 1
-          assert text1[x] == text2[y], ("No diagonal.  " +
-              "Can't happen. (diff_path1)")
-          if last_op == self.DIFF_EQUAL:
-            path[0] = (self.DIFF_EQUAL, text1[x] + path[0][1])
-          else:
-            path[:0] = [(self.DIFF_EQUAL, text1[x])]
-          last_op = self.DIFF_EQUAL
-    return path
-
-  def diff_path2(self, v_map, text1, text2):
-    """Work from the middle back to the end to determine the path.
-
-    Args:
-      v_map: Array of paths.
-      text1: Old string fragment to be diffed.
-      text2: New string fragment to be diffed.
-
-    Returns:
-      Array of diff tuples.
-    """
-    path = []
-    x = len(text1)
-    y = len(text2)
-    last_op = None
-    for d in xrange(len(v_map) - 2, -1, -1):
-      while True:
-        if (x - 1, y) in v_map[d]:
-          x -= 1
-          if last_op == self.DIFF_DELETE:
-            path[-1] = (self.DIFF_DELETE, path[-1][1] + text1[-x - 1])
-          else:
-            path.append((self.DIFF_DELETE, text1[-x - 1]))
-          last_op = self.DIFF_DELETE
-          break
-        elif (x, y - 1) in v_map[d]:
-          y -= 1
-          if last_op == self.DIFF_INSERT:
-            path[-1] = (self.DIFF_INSERT, path[-1][1] + text2[-y - 1])
-          else:
-            path.append((self.DIFF_INSERT, text2[-y - 1]))
-          last_op = self.DIFF_INSERT
-          break
-        else:
-          x -= 1
-          y -= 1
-          assert text1[-x - 1] == text2[-y - 1], ("No diagonal.  " +
-              "Can't happen. (diff_path2)")
-          if last_op == self.DIFF_EQUAL:
-            path[-1] = (self.DIFF_EQUAL, path[-1][1] + text1[-x - 1])
-          else:
-            path.append((self.DIFF_EQUAL, text1[-x - 1]))
-          last_op = self.DIFF_EQUAL
-    return path
-
   def diff_commonPrefix(self, text1, text2):
     """Determine the common prefix of two strings.
 
@@ -1190,6 +1156,8 @@ class diff_match_patch:
       Best match index or -1.
     """
     # Python doesn't have a maxint limit, so ignore this check.
+    # Patterns of any length are matched in one pass, with the bit arrays
+    # held in arbitrary width integers.
     #if self.Match_MaxBits != 0 and len(pattern) > self.Match_MaxBits:
     #  raise ValueError("Pattern too long for this application.")
 
@@ -1229,7 +1197,9 @@ class diff_match_patch:
     matchmask = 1 << (len(pattern) - 1)
     best_loc = -1
 
-    bin_max = len(pattern) + len(text)
+    text_length = len(text)
+    alphabet_get = s.get
+    bin_max = len(pattern) + text_length
     # Empty initialization added to appease pychecker.
     last_rd = None
     for d in xrange(len(pattern)):
@@ -1248,16 +1218,16 @@ class diff_match_patch:
       # Use the result from this iteration as the maximum for the next.
       bin_max = bin_mid
       start = max(1, loc - bin_mid + 1)
-      finish = min(loc + bin_mid, len(text)) + len(pattern)
+      finish = min(loc + bin_mid, text_length) + len(pattern)
 
-      rd = range(finish + 1)
-      rd.append((1 << d) - 1)
+      rd = [0] * (finish + 2)
+      rd[finish + 1] = (1 << d) - 1
       for j in xrange(finish, start - 1, -1):
-        if len(text) <= j - 1:
+        if text_length <= j - 1:
           # Out of range.
           charMatch = 0
         else:
-          charMatch = s.get(text[j - 1], 0)
+          charMatch = alphabet_get(text[j - 1], 0)
         if d == 0:  # First pass: exact match.
           rd[j] = ((rd[j + 1] << 1) | 1) & charMatch
         else:  # Subsequent passes: fuzzy match.
@@ -1293,10 +1263,10 @@ class diff_match_patch:
       Hash of character locations.
     """
     s = {}
+    bit = 1 << len(pattern)
     for char in pattern:
-      s[char] = 0
-    for i in xrange(len(pattern)):
-      s[pattern[i]] |= 1 << (len(pattern) - i - 1)
+      bit >>= 1
+      s[char] = s.get(char, 0) | bit
     return s
 
   #  PATCH FUNCTIONS
@@ -1508,7 +1478,7 @@ class diff_match_patch:
       expected_loc = patch.start2 + delta
       text1 = self.diff_text1(patch.diffs)
       end_loc = -1
-      if len(text1) > self.Match_MaxBits:
+      if self.Match_MaxBits and len(text1) > self.Match_MaxBits:
         # patch_splitMax will only provide an oversized pattern in the case of
         # a monster delete.
         start_loc = self.match_main(text, text1[:self.Match_MaxBits],
@@ -1542,7 +1512,7 @@ class diff_match_patch:
           # Imperfect match.
           # Run a diff to get a framework of equivalent indices.
           diffs = self.diff_main(text1, text2, False)
-          if (len(text1) > self.Match_MaxBits and
+          if (self.Match_MaxBits and len(text1) > self.Match_MaxBits and
               self.diff_levenshtein(diffs) / float(len(text1)) >
               self.Patch_DeleteThreshold):
             # The end points match, but the content is unacceptably bad.
@@ -0,0 +1,338 @@
+#!/usr/bin/python2.4
+
+"""Benchmark suite for diff_match_patch.py
+
+Times diff_main, patch_make, patch_apply and match_main (and match_bitap)
+on three kinds of corpora:
+
+  fixtures   the texts of diff_match_patch_test.py, repeated and mutated,
+             with patches split into Match_MaxBits = 32 character chunks
+             and unsplit (Match_MaxBits = 0).
+  synthetic  random text of 10k to 1M characters with random edits.
+  factsheet  YAML factsheet dumps of 100 to 50,000 rows with random cell
+             edits, inserts and deletes, diffed and patched the way
+             Factsheet.save and Factsheet.revision do.
+
+Each case runs in its own process, which reports the fastest of the
+repeated runs and the growth of the peak resident memory during them.
+
+Usage:
+  python diff_match_patch_benchmark.py [options] [case filter]
+
+  -o FILE   save the results as JSON.
+  -c FILE   compare with results saved earlier and exit with status 1 if
+            a case got slower than the threshold allows (-t, default 0.25
+            for 25%).
+  -q        quick run, without the largest corpora.
+"""
+
+import optparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+try:
+  import yaml
+except ImportError:
+  yaml = None
+
+import diff_match_patch as dmp_module
+
+# Fixtures from diff_match_patch_test.py.
+FIXTURES = [
+    "The quick brown fox jumps over the lazy dog.",
+    "That quick brown fox jumped over a lazy dog.",
+    "The quick red rabbit jumps over the tired tiger.",
+    "I am the very model of a modern major general.",
+    "`Twas brillig, and the slithy toves\nDid gyre and gimble in the wabe:\n"
+    "All mimsy were the borogoves,\nAnd the mome raths outgrabe.\n",
+    "I am the very model of a modern major general,\n"
+    "I've information vegetable, animal, and mineral,\n"
+    "I know the kings of England, and I quote the fights historical,\n"
+    "From Marathon to Waterloo, in order categorical.\n",
+    "abcdefghijklmnopqrstuvwxyz--------------------1234567890",
+]
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz "
+
+
+def mutate(text, rate, rnd):
+  """Returns text with about rate * len(text) characters replaced."""
+  chars = list(text)
+  for _ in xrange(int(len(chars) * rate)):
+    chars[rnd.randrange(len(chars))] = rnd.choice(LETTERS)
+  return "".join(chars)
+
+
+def random_word(rnd, low=3, high=10):
+  return "".join(rnd.choice(LETTERS[:-1])
+                 for _ in xrange(rnd.randint(low, high)))
+
+
+def dump_factsheet(columns, rows):
+  """Returns factsheet content as Factsheet.set_columns_and_rows writes it.
+  Without PyYAML, the same block layout is written by hand, only without
+  yaml's line wrapping."""
+  if yaml is not None:
+    return yaml.safe_dump({"columns": columns, "rows": rows})
+  lines = ["columns: [%s]" % ", ".join(columns), "rows:"]
+  lines.extend("- [%s]" % ", ".join(row) for row in rows)
+  return "\n".join(lines) + "\n"
+
+
+def factsheet_corpus(n_rows, seed):
+  """Returns (old, new): two revisions of a factsheet of n_rows rows, with
+  about 1% of the rows changed, deleted or inserted."""
+  rnd = random.Random(seed)
+  columns = ["word", "translation", "example"]
+  rows = [["%s%d" % (random_word(rnd), i), random_word(rnd),
+           " ".join(random_word(rnd) for _ in xrange(4))]
+          for i in xrange(n_rows)]
+  old = dump_factsheet(columns, rows)
+  rows = [row[:] for row in rows]
+  for _ in xrange(max(1, n_rows // 100)):
+    action = rnd.random()
+    i = rnd.randrange(len(rows))
+    if action < 0.6:
+      rows[i][rnd.randrange(1, len(columns))] = random_word(rnd)
+    elif action < 0.8 and len(rows) > 1:
+      del rows[i]
+    else:
+      rows.insert(i, ["new%d" % i, random_word(rnd), random_word(rnd)])
+  return old, dump_factsheet(columns, rows)
+
+
+def synthetic_corpus(n_chars, seed):
+  """Returns (old, new): random text and a copy with about 20 random
+  inserts, deletes and replacements."""
+  rnd = random.Random(seed)
+  old = "".join(rnd.choice(LETTERS) for _ in xrange(n_chars))
+  new = old
+  for _ in xrange(20):
+    i = rnd.randrange(len(new))
+    j = i + rnd.randint(0, 50)
+    new = new[:i] + "".join(rnd.choice(LETTERS)
+                            for _ in xrange(rnd.randint(0, 50))) + new[j:]
+  return old, new
+
+
+def fixtures_corpus(n_sentences, seed):
+  """Returns (old, new, target): new is an edit of old, and target is old
+  with some noise, to which the patches from old to new are applied."""
+  rnd = random.Random(seed)
+  old = "\n".join(rnd.choice(FIXTURES) for _ in xrange(n_sentences))
+  lines = old.split("\n")
+  for i in rnd.sample(xrange(len(lines)), max(1, len(lines) // 10)):
+    lines[i] = mutate(lines[i], 0.3, rnd)
+  return old, "\n".join(lines), mutate(old, 0.02, rnd)
+
+
+def text_ops(prefix, old, new):
+  """Returns the cases of one corpus as (name, setup) pairs, where setup
+  returns (operation, bytes processed)."""
+  dmp = dmp_module.diff_match_patch()
+  size = len(old) + len(new)
+
+  def diff_main():
+    return (lambda: dmp.diff_main(new, old), size)
+
+  def patch_make():
+    # A reverse patch, as Factsheet.save stores it.
+    return (lambda: dmp.patch_toText(dmp.patch_make(new, old)), size)
+
+  def patch_apply():
+    patch_text = dmp.patch_toText(dmp.patch_make(new, old))
+    def apply():
+      return dmp.patch_apply(dmp.patch_fromText(patch_text), new)[0]
+    return (apply, len(new))
+
+  def match_main():
+    loc = len(old) // 2
+    pattern = old[loc:loc + 30]
+    # The pattern is looked for somewhat away from where it is.
+    return (lambda: dmp.match_main(old, pattern, loc + 100), len(old))
+
+  return [("%s/diff_main" % prefix, diff_main),
+          ("%s/patch_make" % prefix, patch_make),
+          ("%s/patch_apply" % prefix, patch_apply),
+          ("%s/match_main" % prefix, match_main)]
+
+
+def lazy(corpus, *args):
+  """Builds a corpus once, when a case first needs it."""
+  cache = []
+  def get():
+    if not cache:
+      cache.append(corpus(*args))
+    return cache[0]
+  return get
+
+
+def text_cases(prefix, get_corpus):
+  names = [name for (name, _) in text_ops(prefix, "", "")]
+  def setup(i):
+    return lambda: text_ops(prefix, *get_corpus())[i][1]()
+  return [(name, setup(i)) for (i, name) in enumerate(names)]
+
+
+def bitap_case(width):
+  def setup():
+    rnd = random.Random(width)
+    dmp = dmp_module.diff_match_patch()
+    text = "".join(FIXTURES) * 4
+    loc = len(text) // 2
+    pattern = mutate(text[loc:loc + width], 0.1, rnd)
+    return (lambda: dmp.match_bitap(text, pattern, loc + 5), len(text))
+  return ("fixtures/match_bitap/width=%d" % width, setup)
+
+
+def fixtures_patch_case(n_sentences, max_bits):
+  def setup():
+    old, new, target = fixtures_corpus(n_sentences, n_sentences)
+    dmp = dmp_module.diff_match_patch()
+    dmp.Match_MaxBits = max_bits
+    def make_and_apply():
+      return dmp.patch_apply(dmp.patch_make(old, new), target)
+    return (make_and_apply, len(old) + len(new))
+  return ("fixtures/patch/sentences=%d/maxbits=%d" % (n_sentences, max_bits),
+          setup)
+
+
+def all_cases(quick=False):
+  """Returns [(name, setup)] for every case, in order."""
+  cases = []
+  for width in (8, 32, 128):
+    cases.append(bitap_case(width))
+  for n_sentences in (10, 100, 500):
+    for max_bits in (32, 0):
+      cases.append(fixtures_patch_case(n_sentences, max_bits))
+  for n_chars in (10000, 100000) if quick else (10000, 100000, 1000000):
+    cases.extend(text_cases("synthetic/chars=%d" % n_chars,
+                            lazy(synthetic_corpus, n_chars, n_chars)))
+  for n_rows in (100, 1000, 5000) if quick else (100, 1000, 10000, 50000):
+    cases.extend(text_cases("factsheet/rows=%d" % n_rows,
+                            lazy(factsheet_corpus, n_rows, n_rows)))
+  return cases
+
+
+def max_rss_kb():
+  # ru_maxrss is in kilobytes on Linux and in bytes on Mac OS X.
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == "darwin":
+    rss //= 1024
+  return rss
+
+
+def run_case(setup, repeat):
+  """Runs one case in this process and returns its result."""
+  op, n_bytes = setup()
+  rss_before = max_rss_kb()
+  op()  # Warm up, e.g. the regular expressions of patch_fromText.
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    op()
+    seconds = time.time() - start
+    if best is None or seconds < best:
+      best = seconds
+  return {"seconds": best,
+          "bytes": n_bytes,
+          "peak_kb": max_rss_kb() - rss_before}
+
+
+def run_in_child(name, repeat):
+  """Runs one case in a fresh process, so that its peak memory is its own."""
+  child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                            "--case", name, "-r", str(repeat)],
+                           stdout=subprocess.PIPE)
+  output = child.communicate()[0]
+  if child.returncode != 0:
+    raise RuntimeError("Case %s failed." % name)
+  return json.loads(output)
+
+
+def compare(results, baseline, threshold):
+  """Prints the change of each case against the baseline and returns the
+  names of the cases that regressed beyond the threshold."""
+  regressed = []
+  print
+  print "%-45s %10s %10s %8s" % ("case", "base ms", "ms", "change")
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    base = baseline[name]["seconds"]
+    seconds = results[name]["seconds"]
+    ratio = seconds / base if base > 0 else 1.0
+    flag = ""
+    if ratio > 1.0 + threshold:
+      regressed.append(name)
+      flag = "  REGRESSED"
+    print "%-45s %10.2f %10.2f %+7.0f%%%s" % (
+        name, base * 1000, seconds * 1000, (ratio - 1.0) * 100, flag)
+  return regressed
+
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options] [case filter]")
+  parser.add_option("-r", "--repeat", type="int", default=5,
+                    help="runs per case, the fastest counts")
+  parser.add_option("-q", "--quick", action="store_true",
+                    help="skip the largest corpora")
+  parser.add_option("-o", "--output", help="save the results as JSON")
+  parser.add_option("-c", "--compare", help="results to compare with")
+  parser.add_option("-t", "--threshold", type="float", default=0.25,
+                    help="slowdown that counts as a regression")
+  parser.add_option("--case", help=optparse.SUPPRESS_HELP)
+  (options, args) = parser.parse_args()
+
+  cases = all_cases(options.quick)
+  if options.case:
+    # Child process: run a single case and report it.
+    setup = dict(cases + all_cases(not options.quick))[options.case]
+    print json.dumps(run_case(setup, options.repeat))
+    return 0
+
+  if args:
+    cases = [(name, setup) for (name, setup) in cases if args[0] in name]
+  results = {}
+  print "%-45s %10s %10s %10s" % ("case", "ms", "MB/s", "peak KB")
+  for name, _ in cases:
+    result = run_in_child(name, options.repeat)
+    results[name] = result
+    mb_per_second = result["bytes"] / max(result["seconds"], 1e-9) / 1e6
+    print "%-45s %10.2f %10.2f %10d" % (
+        name, result["seconds"] * 1000, mb_per_second, result["peak_kb"])
+    sys.stdout.flush()
+
+  if options.output:
+    f = open(options.output, "w")
+    try:
+      json.dump(results, f, indent=1, sort_keys=True)
+    finally:
+      f.close()
+
+  if options.compare:
+    f = open(options.compare)
+    try:
+      baseline = json.load(f)
+    finally:
+      f.close()
+    regressed = compare(results, baseline, options.threshold)
+    if regressed:
+      print
+      print "%d case(s) slower than the baseline by more than %d%%." % (
+          len(regressed), options.threshold * 100)
+      return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -18,6 +18,8 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import sys
+import time
 import unittest
 import diff_match_patch as dmp_module
 # Force a module reload to make debugging easier (at least in PythonWin).
@@ -367,38 +369,25 @@ class DiffTest(DiffMatchPatchTest):
     # Levenshtein with middle equality.
     self.assertEquals(7, self.dmp.diff_levenshtein([(self.dmp.DIFF_DELETE, "abc"), (self.dmp.DIFF_EQUAL, "xyz"), (self.dmp.DIFF_INSERT, "1234")]))
 
-  def testDiffPath(self):
-    # Trace a path from back to front.
-    # Single letters.
-    v_map = []
-    v_map.append({(0,0):True})
-    v_map.append({(0,1):True, (1,0):True})
-    v_map.append({(0,2):True, (2,0):True, (2,2):True})
-    v_map.append({(0,3):True, (2,3):True, (3,0):True, (4,3):True})
-    v_map.append({(0,4):True, (2,4):True, (4,0):True, (4,4):True, (5,3):True})
-    v_map.append({(0,5):True, (2,5):True, (4,5):True, (5,0):True, (6,3):True, (6,5):True})
-    v_map.append({(0,6):True, (2,6):True, (4,6):True, (6,6):True, (7,5):True})
-    self.assertEquals([(self.dmp.DIFF_INSERT, "W"), (self.dmp.DIFF_DELETE, "A"), (self.dmp.DIFF_EQUAL, "1"), (self.dmp.DIFF_DELETE, "B"), (self.dmp.DIFF_EQUAL, "2"), (self.dmp.DIFF_INSERT, "X"), (self.dmp.DIFF_DELETE, "C"), (self.dmp.DIFF_EQUAL, "3"), (self.dmp.DIFF_DELETE, "D")], self.dmp.diff_path1(v_map, "A1B2C3D", "W12X3"))
-
-    v_map.pop()
-    self.assertEquals([(self.dmp.DIFF_EQUAL, "4"), (self.dmp.DIFF_DELETE, "E"), (self.dmp.DIFF_INSERT, "Y"), (self.dmp.DIFF_EQUAL, "5"), (self.dmp.DIFF_DELETE, "F"), (self.dmp.DIFF_EQUAL, "6"), (self.dmp.DIFF_DELETE, "G"), (self.dmp.DIFF_INSERT, "Z")], self.dmp.diff_path2(v_map, "4E5F6G", "4Y56Z"))
-
-    # Double letters.
-    v_map = []
-    v_map.append({(0,0):True})
-    v_map.append({(0,1):True, (1,0):True})
-    v_map.append({(0,2):True, (1,1):True, (2,0):True})
-    v_map.append({(0,3):True, (1,2):True, (2,1):True, (3,0):True})
-    v_map.append({(0,4):True, (1,3):True, (3,1):True, (4,0):True, (4,4):True})
-    self.assertEquals([(self.dmp.DIFF_INSERT, "WX"), (self.dmp.DIFF_DELETE, "AB"), (self.dmp.DIFF_EQUAL, "12")], self.dmp.diff_path1(v_map, "AB12", "WX12"))
-
-    v_map = []
-    v_map.append({(0,0):True})
-    v_map.append({(0,1):True, (1,0):True})
-    v_map.append({(1,1):True, (2,0):True, (2,4):True})
-    v_map.append({(2,1):True, (2,5):True, (3,0):True, (3,4):True})
-    v_map.append({(2,6):True, (3,5):True, (4,4):True})
-    self.assertEquals([(self.dmp.DIFF_DELETE, "CD"), (self.dmp.DIFF_EQUAL, "34"), (self.dmp.DIFF_INSERT, "YZ")], self.dmp.diff_path2(v_map, "CD34", "34YZ"))
+  def testDiffBisect(self):
+    # Normal.
+    a = "cat"
+    b = "map"
+    # Since the resulting diff hasn't been normalized, it would be ok if
+    # the insertion and deletion pairs are swapped.
+    # If the order changes, tweak this test as required.
+    self.assertEquals([(self.dmp.DIFF_DELETE, "c"), (self.dmp.DIFF_INSERT, "m"), (self.dmp.DIFF_EQUAL, "a"), (self.dmp.DIFF_DELETE, "t"), (self.dmp.DIFF_INSERT, "p")], self.dmp.diff_bisect(a, b, sys.maxint))
+
+    # Timeout.
+    self.assertEquals([(self.dmp.DIFF_DELETE, "cat"), (self.dmp.DIFF_INSERT, "map")], self.dmp.diff_bisect(a, b, 0))
+
+    # Large texts are diffed exactly: the diff rebuilds both texts and
+    # its edit distance matches the known number of changes.
+    a = "".join(["line %d of a long text\n" % x for x in xrange(2000)])
+    b = a.replace("line 1000 ", "LINE 1000 ").replace("line 5 ", "")
+    diffs = self.dmp.diff_bisect(a, b, sys.maxint)
+    self.assertEquals((a, b), self.diff_rebuildtexts(diffs))
+    self.assertEquals(11, self.dmp.diff_levenshtein(diffs))
 
   def testDiffMain(self):
     # Perform a trivial diff.
@@ -420,7 +409,6 @@ class DiffTest(DiffMatchPatchTest):
     # Perform a real diff.
     # Switch off the timeout.
     self.dmp.Diff_Timeout = 0
-    self.dmp.Diff_DualThreshold = 32
     # Simple cases.
     self.assertEquals([(self.dmp.DIFF_DELETE, "a"), (self.dmp.DIFF_INSERT, "b")], self.dmp.diff_main("a", "b", False))
 
@@ -433,20 +421,21 @@ class DiffTest(DiffMatchPatchTest):
 
     self.assertEquals([(self.dmp.DIFF_INSERT, "xaxcx"), (self.dmp.DIFF_EQUAL, "abc"), (self.dmp.DIFF_DELETE, "y")], self.dmp.diff_main("abcy", "xaxcxabc", False))
 
-    # Sub-optimal double-ended diff.
-    self.dmp.Diff_DualThreshold = 2
-    self.assertEquals([(self.dmp.DIFF_INSERT, "x"), (self.dmp.DIFF_EQUAL, "a"), (self.dmp.DIFF_DELETE, "b"), (self.dmp.DIFF_INSERT, "x"), (self.dmp.DIFF_EQUAL, "c"), (self.dmp.DIFF_DELETE, "y"), (self.dmp.DIFF_INSERT, "xabc")], self.dmp.diff_main("abcy", "xaxcxabc", False))
-    self.dmp.Diff_DualThreshold = 32
-
     # Timeout.
-    self.dmp.Diff_Timeout = 0.001  # 1ms
+    self.dmp.Diff_Timeout = 0.1  # 100ms
     a = "`Twas brillig, and the slithy toves\nDid gyre and gimble in the wabe:\nAll mimsy were the borogoves,\nAnd the mome raths outgrabe.\n"
     b = "I am the very model of a modern major general,\nI've information vegetable, animal, and mineral,\nI know the kings of England, and I quote the fights historical,\nFrom Marathon to Waterloo, in order categorical.\n"
     # Increase the text lengths by 1024 times to ensure a timeout.
     for x in xrange(10):
       a = a + a
       b = b + b
-    self.assertEquals(None, self.dmp.diff_map(a, b))
+    startTime = time.time()
+    diffs = self.dmp.diff_main(a, b, False)
+    endTime = time.time()
+    # The diff is still valid, it is just not minimal.
+    self.assertEquals((a, b), self.diff_rebuildtexts(diffs))
+    # Test that we took at least the timeout period.
+    self.assertTrue(self.dmp.Diff_Timeout <= endTime - startTime)
     self.dmp.Diff_Timeout = 0
 
     # Test the linemode speedup.
@@ -460,6 +449,14 @@ class DiffTest(DiffMatchPatchTest):
     texts_textmode = self.diff_rebuildtexts(self.dmp.diff_main(a, b, False))
     self.assertEquals(texts_textmode, texts_linemode)
 
+    # Texts above Diff_LineModeThreshold are diffed line by line first,
+    # even if checklines is false.
+    self.dmp.Diff_LineModeThreshold = 200
+    self.assertEquals(self.dmp.diff_main(a, b, True), self.dmp.diff_main(a, b, False))
+    self.dmp.Diff_LineModeThreshold = 0
+    texts_forced = self.diff_rebuildtexts(self.dmp.diff_main(a, b, False))
+    self.assertEquals(texts_textmode, texts_forced)
+
 
 class MatchTest(DiffMatchPatchTest):
   """MATCH TEST FUNCTIONS"""
@@ -519,6 +516,12 @@ class MatchTest(DiffMatchPatchTest):
     self.dmp.Match_Distance = 1000  # Loose location.
     self.assertEquals(0, self.dmp.match_bitap("abcdefghijklmnopqrstuvwxyz", "abcdefg", 24))
 
+    # Patterns wider than 32 bits.
+    text = "0123456789" * 5 + "The quick brown fox jumps over the lazy dog." + "0123456789" * 5
+    self.assertEquals(50, self.dmp.match_bitap(text, "9The quick brown fox jumps over the lazy dog.0"[1:-1], 40))
+    self.assertEquals(50, self.dmp.match_bitap(text, "The quick brown fix jumps over the lazy dog.", 40))
+    self.assertEquals(-1, self.dmp.match_bitap(text, "I am the very model of a modern major general.", 40))
+
 
   def testMatchMain(self):
     # Full match.
@@ -728,6 +731,16 @@ class PatchTest(DiffMatchPatchTest):
     self.dmp.Match_Threshold = 0.5
     self.dmp.Match_Distance = 1000
 
+    # Unsplit patches, matched with their full context.
+    self.dmp.Match_MaxBits = 0
+    patches = self.dmp.patch_make("The quick brown fox jumps over the lazy dog.", "Woof")
+    self.assertEquals(1, len(patches))
+    results = self.dmp.patch_apply(patches, "The quick red rabbit jumps over the tired tiger.")
+    self.assertEquals(("Woof", [True]), results)
+    results = self.dmp.patch_apply(patches, "I am the very model of a modern major general.")
+    self.assertEquals(("I am the very model of a modern major general.", [False]), results)
+    self.dmp.Match_MaxBits = 32
+
     # No side effects.
     patches = self.dmp.patch_make("", "test")
     patchstr = self.dmp.patch_toText(patches)
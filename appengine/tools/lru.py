@@ -0,0 +1,45 @@
+""" A small size-bounded least-recently-used cache for in-process memoization.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ Dict-like cache that evicts the least recently used entry once
+        it holds more than max_size entries.
+    """
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
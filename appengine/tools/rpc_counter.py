@@ -0,0 +1,52 @@
+""" Counts the API calls (RPCs) made while a counter is active.
+
+Example code:
+
+from tools.rpc_counter import RPCCounter
+with RPCCounter() as counter:
+    box.card_to_study()
+logging.info(counter.count('datastore_v3'))
+"""
+
+import threading
+
+from google.appengine.api import apiproxy_stub_map
+
+_local = threading.local()
+_installed = False
+
+
+def _hook(service, call, request, response):
+    for counter in getattr(_local, 'counters', []):
+        counter.calls.append((service, call))
+
+
+def install():
+    """ Installs the pre-call hook. Only needs to be run once. """
+    global _installed
+    if not _installed:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_counter', _hook)
+        _installed = True
+
+
+class RPCCounter(object):
+    """ Context manager recording (service, call) for each RPC made
+        in the current thread while it is active.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __enter__(self):
+        install()
+        if not hasattr(_local, 'counters'):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.counters.remove(self)
+        return False
+
+    def count(self, service=None, call=None):
+        return len([1 for (s, c) in self.calls
+                    if (service is None or s == service) and (call is None or c == call)])
@@ -18,9 +18,12 @@ urlpatterns = patterns('',
    (r"^box/create$","cardbox.views.box_create"),
    (r"^box/([0-9]+)/$","cardbox.views.box_edit"),
    (r"^box/([0-9]+)/stats$","cardbox.views.box_stats"),
+   (r"^box/([0-9]+)/benchmark$","cardbox.views.study_benchmark"),
    
    (r"^box/([0-9]+)/study$","cardbox.views.study"),
    (r"^box/([0-9]+)/next_card$","cardbox.views.next_card"),
+   (r"^box/([0-9]+)/next_cards$","cardbox.views.next_cards"),
+   (r"^box/([0-9]+)/update_cards$","cardbox.views.update_cards"),
    (r"^box/([0-9]+)/update_card","cardbox.views.update_card"),
    
    (r"^box/(?P<box_id>[0-9]+)/card/(?P<card_id>[0-9]+\-[A-Za-z0-9\-\_\.]+)/view$","cardbox.views.card_view"),
@@ -29,6 +32,9 @@ urlpatterns = patterns('',
    (r"^template/([a-z0-9\_]+)/view$","cardbox.views.template_view"),
    (r"^template/([a-z0-9\_]+)/fields$","cardbox.views.template_fields"),
    
+   (r"^admin/cache_stats$","cardbox.views.cache_stats"),
+   (r"^cron/reconcile_box_counters$","cardbox.views.cron_reconcile_box_counters"),
+   
    (r"^mobile/$","cardbox.views.mobile_front"),
    (r"^mobile/box/([0-9]+)/study","cardbox.views.mobile_study"),
    